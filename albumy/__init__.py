@@ -1,18 +1,36 @@
+import itertools
 import os
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
+from datetime import datetime, timedelta
 
 import click
-from flask import Flask, render_template
-from flask_login import current_user
+from flask import Flask, render_template, redirect, url_for
+from flask_login import current_user, logout_user
 from flask_wtf.csrf import CSRFError
+from sqlalchemy.orm.exc import ObjectDeletedError
 
+from albumy import paths
 from albumy.blueprints.admin import admin_bp
 from albumy.blueprints.ajax import ajax_bp
 from albumy.blueprints.auth import auth_bp
 from albumy.blueprints.main import main_bp
 from albumy.blueprints.user import user_bp
-from albumy.extensions import bootstrap, db, login_manager, mail, moment, dropzone, csrf, avatars, whooshee
-from albumy.models import User, Role, Permission, Photo, Tag, Comment, Collect, Follow, Notification
+from albumy.cache import cache
+from albumy.emails import send_queued_mail
+from albumy.identity import identity_cache, UserSnapshot  # 同时注册修改用户后使身份缓存失效的事件
+from albumy.extensions import bootstrap, db, login_manager, mail, moment, dropzone, csrf, avatars
+from albumy.models import User, Role, Permission, Photo, Tag, Comment, Collect, Follow, Notification, \
+    Tombstone, MailMessage, rebuild_counters
+from albumy.notifications import unread_count, prune_notifications, notification_writer
+from albumy.pubsub import pubsub
+from albumy.reaper import reap_files, due_tombstones, referenced_files
+from albumy.search import fts_enabled, reindex as search_index
 from albumy.settings import config
+from albumy.storage import storage
+from albumy.thumbnails import thumbnails_ready, thumbnails_failed
+from albumy.timeline import rebuild_timeline
+from albumy.uploads import clean_partials
+from albumy.utils import resize_images
 
 
 def create_app(config_name=None):
@@ -29,6 +47,7 @@ def create_app(config_name=None):
     register_errorhandlers(app)
     register_shell_context(app)
     register_template_context(app)
+    register_background_tasks(app)
 
     return app
 
@@ -42,7 +61,9 @@ def register_extensions(app: Flask):
     mail.init_app(app)
     moment.init_app(app)
     csrf.init_app(app)
-    whooshee.init_app(app)
+    storage.init_app(app)
+    cache.init_app(app)
+    pubsub.init_app(app)
 
 
 def register_blueprints(app: Flask):
@@ -66,12 +87,19 @@ def register_template_context(app: Flask):
     def make_template_context():
         # 查询当前用户的未读消息数量，作为模板全局变量使用
         if current_user.is_authenticated:
-            notification_count = Notification.query.with_parent(current_user).filter_by(is_read=False).count()
+            notification_count = unread_count(current_user.id)
         else:
             notification_count = None
         return dict(notification_count=notification_count)
 
 
+def register_background_tasks(app: Flask):
+    @app.before_first_request
+    def start_background_tasks():
+        # 每个工作进程处理第一个请求时启动后台任务，处理重启前遗留的消息事件
+        notification_writer.start()
+
+
 def register_errorhandlers(app: Flask):
     @app.errorhandler(400)
     def bad_request(e):
@@ -97,6 +125,19 @@ def register_errorhandlers(app: Flask):
     def handle_csrf_error(e):
         return render_template('errors/400.html', description=e.description), 400
 
+    @app.errorhandler(ObjectDeletedError)
+    def handle_deleted_user(e):
+        # 使用进程内的身份缓存时，其他进程删除的用户在快照过期前仍会被load_user()返回，
+        # 访问快照之外的字段时才发现用户已不存在，这时退出登录而不是返回500错误
+        db.session.rollback()
+        if current_user.is_authenticated:
+            user_id = db.inspect(current_user._get_current_object()).identity[0]  # 回滚后字段都已过期，不能访问id
+            if UserSnapshot.load(user_id) is None:
+                identity_cache.invalidate([user_id])
+                logout_user()
+                return redirect(url_for('auth.login'))
+        raise e
+
 
 def register_commands(app: Flask):
     @app.cli.command()
@@ -153,12 +194,140 @@ def register_commands(app: Flask):
         fake_collect(collect)
         click.echo('Generating %d comments...' % comment)
         fake_comment(comment)
+        click.echo('Rebuilding counters...')
+        rebuild_counters()
+        click.echo('Rebuilding timelines...')
+        rebuild_timeline()
 
         click.echo('Done.')
 
     @app.cli.command()
-    def reindex():
-        """为whooshee重新创建索引"""
+    @click.option('--incremental', is_flag=True, help='Only index missing rows and drop deleted ones.')
+    def reindex(incremental):
+        """Rebuild the full-text search index."""
+        if not fts_enabled():
+            click.echo('Full-text index is only used with SQLite, nothing to do.')
+            return
         click.echo('Reindexing for database...')
-        whooshee.reindex()
+        for name, count in search_index(incremental).items():
+            click.echo('%s: %d rows indexed.' % (name, count))
+        click.echo('Done.')
+
+    @app.cli.command()
+    def recount():
+        """Rebuild the denormalized counters of users, photos and tags."""
+        click.echo('Rebuilding counters...')
+        rebuild_counters()
         click.echo('Done.')
+
+    @app.cli.command('rebuild-timeline')
+    def rebuild_timeline_command():
+        """Rebuild the materialized home timelines from the follow graph."""
+        click.echo('Rebuilding timelines...')
+        rebuild_timeline()
+        click.echo('Done.')
+
+    @app.cli.command()
+    @click.option('--all', 'all_photos', is_flag=True, help='Regenerate thumbnails for all photos.')
+    def thumbnails(all_photos):
+        """Generate thumbnails for photos whose renditions are pending or failed."""
+        query = db.session.query(Photo.id, Photo.blob_id, Photo.filename)
+        if not all_photos:
+            query = query.filter(Photo.rendition_status != 'ready')
+        # 内容相同的图片共用缩略图，只需要生成一次
+        photos = {blob_id or -photo_id: (photo_id, blob_id, filename) for photo_id, blob_id, filename in query}
+        photos = list(photos.values())
+        click.echo('Generating thumbnails for %d photos...' % len(photos))
+        with click.progressbar(photos) as bar:
+            for photo_id, blob_id, filename in bar:
+                try:
+                    filenames = resize_images(storage.photos.path(filename), filename,
+                                              app.config['ALBUMY_PHOTO_SUFFIX'],
+                                              tuple(app.config['ALBUMY_PHOTO_VARIANTS'].values()))
+                except Exception as e:
+                    thumbnails_failed(photo_id, blob_id, e)
+                else:
+                    thumbnails_ready(photo_id, blob_id, filename, filenames)
+        click.echo('Done.')
+
+    @app.cli.command('migrate-uploads')
+    @click.option('--workers', default=8, help='Number of parallel workers.')
+    @click.option('--batch', default=1000, help='Number of files moved per batch.')
+    def migrate_uploads(workers, batch):
+        """Move uploads and avatars into the configured sharded layout, safe to re-run."""
+        for directory, exclude in [(app.config['ALBUMY_UPLOAD_PATH'], (app.config['AVATARS_SAVE_PATH'],)),
+                                   (app.config['AVATARS_SAVE_PATH'], ())]:
+            if not os.path.isdir(directory):
+                continue
+            click.echo('Migrating %s...' % directory)
+            moves = paths.misplaced(directory, exclude)
+            moved = 0
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                pending = set()
+                for files in iter(lambda: list(itertools.islice(moves, batch)), []):
+                    pending.add(executor.submit(paths.move_files, directory, files))
+                    # 最多同时提交两倍于线程数的批次，遍历目录与移动文件交替进行，内存占用不随文件数量增长
+                    if len(pending) < workers * 2:
+                        continue
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        moved += future.result()
+                        click.echo('%d files moved.' % moved)
+                for future in as_completed(pending):
+                    moved += future.result()
+                    click.echo('%d files moved.' % moved)
+        click.echo('Done.')
+
+    @app.cli.command('reap-files')
+    @click.option('--dry-run', is_flag=True, help='Only report the files that would be deleted.')
+    def reap_files_command(dry_run):
+        """Delete the files of removed photos and users queued in the tombstone table."""
+        if not dry_run:
+            click.echo('Deleting files...')
+            while reap_files():
+                pass
+        max_attempts = app.config['ALBUMY_REAPER_MAX_ATTEMPTS']
+        gave_up = db.func.sum(db.case([(Tombstone.attempts >= max_attempts, 1)], else_=0))
+        for storage_name, total, failed in db.session.query(Tombstone.storage, db.func.count(), gave_up) \
+                .group_by(Tombstone.storage):
+            click.echo('%s: %d queued, %d gave up after %d attempts.' % (storage_name, total, failed, max_attempts))
+        if dry_run:
+            tombstones = due_tombstones(db.session).order_by(Tombstone.id) \
+                .limit(app.config['ALBUMY_REAPER_BATCH']).all()
+            for storage_name in {tombstone.storage for tombstone in tombstones}:
+                filenames = [tombstone.filename for tombstone in tombstones if tombstone.storage == storage_name]
+                used = referenced_files(db.session, storage_name, filenames)
+                for filename in filenames:
+                    click.echo('%s %s/%s' % ('skip (in use)' if filename in used else 'delete', storage_name, filename))
+            for tombstone in Tombstone.query.filter(Tombstone.attempts >= max_attempts):
+                click.echo('failed %s/%s: %s' % (tombstone.storage, tombstone.filename, tombstone.last_error))
+        click.echo('Done.')
+
+    @app.cli.command('clean-uploads')
+    def clean_uploads():
+        """Delete chunked uploads that were not finished within ALBUMY_CHUNK_TTL."""
+        removed = clean_partials(app.config['ALBUMY_CHUNK_TTL'])
+        click.echo('%d stale upload files deleted.' % removed)
+
+    @app.cli.command('prune-notifications')
+    @click.option('--days', type=int, help='Delete read notifications older than this, '
+                                           'defaults to ALBUMY_NOTIFICATION_RETENTION_DAYS.')
+    def prune_notifications_command(days):
+        """Delete old read notifications in batches."""
+        if days is None:
+            days = app.config['ALBUMY_NOTIFICATION_RETENTION_DAYS']
+        deleted = prune_notifications(datetime.utcnow() - timedelta(days=days))
+        click.echo('%d notifications deleted.' % deleted)
+
+    @app.cli.command('send-mail')
+    def send_mail_command():
+        """Send the queued emails that are due and report the ones that failed."""
+        click.echo('Sending emails...')
+        while send_queued_mail():
+            pass
+        max_attempts = app.config['ALBUMY_MAIL_MAX_ATTEMPTS']
+        click.echo('%d emails queued.' % MailMessage.query.filter(MailMessage.attempts < max_attempts).count())
+        for message in MailMessage.query.filter(MailMessage.attempts >= max_attempts):
+            click.echo('failed %s "%s": %s' % (message.recipient, message.subject, message.last_error))
+        click.echo('Done.')
+
@@ -4,7 +4,9 @@ from flask_login import login_required
 from albumy.decorators import admin_required, permission_required
 from albumy.extensions import db
 from albumy.forms.admin import EditProfileAdminForm
+from albumy.leaderboard import tag_leaderboard
 from albumy.models import Role, User, Tag, Photo, Comment
+from albumy.pagination import keyset_paginate
 from albumy.utils import redirect_back
 
 admin_bp = Blueprint('admin', __name__)
@@ -48,6 +50,7 @@ def edit_profile_admin(user_id):
         user.username = form.username.data
         user.email = form.email.data
         db.session.commit()
+        Role.clear_permission_cache()
         flash('Profile updated.', 'success')
         return redirect_back()
     form.name.data = user.name
@@ -109,6 +112,7 @@ def delete_tag(tag_id):
     tag = Tag.query.get_or_404(tag_id)
     db.session.delete(tag)
     db.session.commit()
+    tag_leaderboard.remove(tag_id)
     flash('Tag deleted.', 'info')
     return redirect_back()
 
@@ -118,7 +122,6 @@ def delete_tag(tag_id):
 @permission_required('MODERATE')
 def manage_user():
     filter_rule = request.args.get('filter', 'all')  # all, locked, blocked, administrator, moderator
-    page = request.args.get('page', 1, type=int)
     per_page = current_app.config['ALBUMY_MANAGE_USER_PER_PAGE']
     administrator = Role.query.filter_by(name='Administrator').first()
     moderator = Role.query.filter_by(name='Moderator').first()
@@ -134,7 +137,7 @@ def manage_user():
     else:
         filtered_users = User.query
 
-    pagination = filtered_users.order_by(User.member_since.desc()).paginate(page, per_page)
+    pagination = keyset_paginate(filtered_users, User.member_since, User.id, per_page=per_page, approximate=True)
     users = pagination.items
     return render_template('admin/manage_user.html', pagination=pagination, users=users)
 
@@ -144,14 +147,13 @@ def manage_user():
 @login_required
 @permission_required('MODERATE')
 def manage_photo(order):
-    page = request.args.get('page', 1, type=int)
     per_page = current_app.config['ALBUMY_MANAGE_PHOTO_PER_PAGE']
     order_rule = 'flag'
     if order == 'by_time':
-        pagination = Photo.query.order_by(Photo.timestamp.desc()).paginate(page, per_page)
+        pagination = keyset_paginate(Photo.query, Photo.timestamp, Photo.id, per_page=per_page, approximate=True)
         order_rule = 'time'
     else:
-        pagination = Photo.query.order_by(Photo.flag.desc()).paginate(page, per_page)
+        pagination = keyset_paginate(Photo.query, Photo.flag, Photo.id, per_page=per_page, approximate=True)
     photos = pagination.items
     return render_template('admin/manage_photo.html', pagination=pagination, photos=photos, order_rule=order_rule)
 
@@ -160,9 +162,8 @@ def manage_photo(order):
 @login_required
 @permission_required('MODERATE')
 def manage_tag():
-    page = request.args.get('page', 1, type=int)
     per_page = current_app.config['ALBUMY_MANAGE_TAG_PER_PAGE']
-    pagination = Tag.query.order_by(Tag.id.desc()).paginate(page, per_page)
+    pagination = keyset_paginate(Tag.query, Tag.id, per_page=per_page, approximate=True)
     tags = pagination.items
     return render_template('admin/manage_tag.html', pagination=pagination, tags=tags)
 
@@ -172,13 +173,13 @@ def manage_tag():
 @login_required
 @permission_required('MODERATE')
 def manage_comment(order):
-    page = request.args.get('page', 1, type=int)
     per_page = current_app.config['ALBUMY_MANAGE_COMMENT_PER_PAGE']
     order_rule = 'flag'
     if order == 'by_time':
-        pagination = Comment.query.order_by(Comment.timestamp.desc()).paginate(page, per_page)
+        pagination = keyset_paginate(Comment.query, Comment.timestamp, Comment.id, per_page=per_page,
+                                     approximate=True)
         order_rule = 'time'
     else:
-        pagination = Comment.query.order_by(Comment.flag.desc()).paginate(page, per_page)
+        pagination = keyset_paginate(Comment.query, Comment.flag, Comment.id, per_page=per_page, approximate=True)
     comments = pagination.items
     return render_template('admin/manage_comment.html', pagination=pagination, comments=comments, order_rule=order_rule)
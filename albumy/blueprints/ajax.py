@@ -1,8 +1,17 @@
-from flask import Blueprint, render_template, jsonify
+import json
+import queue
+import time
+
+from flask import Blueprint, render_template, jsonify, request, url_for, current_app, Response, \
+    stream_with_context
 from flask_login import current_user
 
-from albumy.models import User, Notification, Photo
-from albumy.notifications import push_collect_notification, push_follow_notification
+from albumy.extensions import db
+from albumy.models import User, Photo
+from albumy.notifications import push_collect_notification, push_follow_notification, unread_count, \
+    notification_channel
+from albumy.pubsub import pubsub
+from albumy.typeahead import typeahead
 
 ajax_bp = Blueprint('ajax', __name__)
 
@@ -13,22 +22,67 @@ def notifications_count():
     if not current_user.is_authenticated:
         return jsonify(message='Login required.'), 403
 
-    count = Notification.query.with_parent(current_user).filter_by(is_read=False).count()
-    return jsonify(count=count)
+    return jsonify(count=unread_count(current_user.id))
+
+
+@ajax_bp.route('/notifications-stream')
+def notifications_stream():
+    """使用Server-Sent Events推送当前用户的未读消息数量和新消息，代替定时请求notifications_count。
+    每个连接在推送期间一直占用一个工作线程，部署时需要使用gevent等异步工作进程"""
+    if not current_user.is_authenticated:
+        return jsonify(message='Login required.'), 403
+
+    channel = notification_channel(current_user.id)
+    subscriber = pubsub.subscribe(channel)
+    count = unread_count(current_user.id)
+    db.session.remove()  # 推送期间不再访问数据库，立即归还数据库连接
+    heartbeat = current_app.config['ALBUMY_SSE_HEARTBEAT']
+    deadline = time.monotonic() + current_app.config['ALBUMY_SSE_TIMEOUT']
+
+    def generate():
+        try:
+            yield 'retry: 5000\nevent: count\ndata: %s\n\n' % json.dumps({'count': count})
+            while time.monotonic() < deadline:
+                try:
+                    message = json.loads(subscriber.get(timeout=heartbeat))
+                except queue.Empty:
+                    yield ': heartbeat\n\n'  # 注释行，浏览器会忽略
+                    continue
+                yield 'event: %s\ndata: %s\n\n' % (message['event'], json.dumps(message['data']))
+        finally:  # 客户端断开连接或超时
+            pubsub.unsubscribe(channel, subscriber)
+
+    # 禁用Nginx对响应的缓冲，否则事件不会立即发送给浏览器
+    return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@ajax_bp.route('/typeahead')
+def search_typeahead():
+    """搜索框的输入提示：返回以q开头的用户名和标签名"""
+    q = request.args.get('q', '').strip()
+    if not q:
+        return jsonify(users=[], tags=[])
+    users = [dict(id=id, username=username, url=url_for('user.index', username=username))
+             for id, username in typeahead.suggest(q, 'user')]
+    tags = [dict(id=id, name=name, url=url_for('main.show_tag', tag_id=id))
+            for id, name in typeahead.suggest(q, 'tag')]
+    return jsonify(users=users, tags=tags)
 
 
 @ajax_bp.route('/profile/<int:user_id>')
 def get_profile(user_id):
     """通过ajax方式提供用户信息"""
     user = User.query.get_or_404(user_id)
-    return render_template('main/profile_popup.html', user=user)
+    follow_state = current_user.follow_states([user.id]).get(user.id)
+    return render_template('main/profile_popup.html', user=user, follow_state=follow_state)
 
 
 @ajax_bp.route('/followers-count/<int:user_id>')
 def followers_count(user_id):
     """查询用户的关注者数量，其中需要减去自己"""
     user = User.query.get_or_404(user_id)
-    count = user.followers.count() - 1  # minus user self
+    count = user.followers_count - 1  # minus user self
     return jsonify(count=count)
 
 
@@ -45,7 +99,7 @@ def follow(username):
         return jsonify(message='No permission.'), 403
 
     user = User.query.filter_by(username=username).first_or_404()
-    if current_user.if_following(user):
+    if current_user.is_following(user):
         return jsonify(message='Already followed.'), 400
 
     current_user.follow(user)
@@ -70,7 +124,7 @@ def unfollow(username):
 @ajax_bp.route('/<int:photo_id>/collectors-count')
 def collectors_count(photo_id):
     photo = Photo.query.get_or_404(photo_id)
-    count = len(photo.collectors)
+    count = photo.collectors_count
     return jsonify(count=count)
 
 
@@ -1,16 +1,24 @@
-import os
-
 from flask import Blueprint, render_template, current_app, request, \
-    send_from_directory, abort, flash, redirect, url_for
+    abort, flash, redirect, url_for, jsonify
 from flask_login import login_required, current_user
-from sqlalchemy.sql.expression import func
+from sqlalchemy.orm import joinedload
 
 from albumy.decorators import confirm_required, permission_required
+from albumy.explore import explore_pool
 from albumy.extensions import db
 from albumy.forms.main import DescriptionForm, TagForm, CommentForm
-from albumy.models import User, Photo, Tag, Comment, Collect, Notification, Follow
-from albumy.notifications import push_comment_notification, push_collect_notification
-from albumy.utils import rename_image, resize_image, flash_errors, redirect_back
+from albumy.leaderboard import tag_leaderboard
+from albumy.models import User, Photo, Tag, Comment, Collect, Notification
+from albumy.notifications import push_comment_notification, push_collect_notification, add_unread_count, \
+    reset_unread_count
+from albumy.pagination import keyset_paginate
+from albumy.search import search_page
+from albumy.storage import storage
+from albumy.thumbnails import generate_thumbnails
+from albumy.timeline import read_timeline, fan_out_photo
+from albumy.uploads import receive_chunk, upload_status
+from albumy.utils import store_upload, store_file, negotiate_image, send_upload, flash_errors, redirect_back, \
+    count_comment_thread
 
 main_bp = Blueprint('main', __name__)
 
@@ -19,28 +27,23 @@ main_bp = Blueprint('main', __name__)
 def index():
     """在主页显示当前用户关注的人最新上传的图片和最热门的10个tag"""
     if current_user.is_authenticated:
-        page = request.args.get('page', 1, type=int)
+        cursor = request.args.get('after')
         per_page = current_app.config['ALBUMY_PHOTO_PER_PAGE']
-        # 依据Follow.followed_id == Photo.author_id联结Follow和Photo表，即图片作者是我的关注
-        # 然后根据关注者是当前用户进行筛选，最会根据图片时间排序、分页
-        pagination = Photo.query \
-            .join(Follow, Follow.followed_id == Photo.author_id) \
-            .filter(Follow.follower_id == current_user.id) \
-            .order_by(Photo.timestamp.desc()) \
-            .paginate(page, per_page)
+        # 从物化的时间线中按(时间, id)游标读取关注用户的图片，见albumy/timeline.py
+        pagination = read_timeline(current_user, cursor=cursor, per_page=per_page)
         photos = pagination.items
     else:
         pagination = None
         photos = None
-    # 使用次数最多的10个标签, 联结Tag和Photo， 根据Tag的id进行分组，选出photo数量最多的10个tag
-    tags = Tag.query.join(Tag.photos).group_by(Tag.id).order_by(func.count(Photo.id).desc()).limit(10)
+    # 使用次数最多的10个标签，由内存中的排行榜维护，见albumy/leaderboard.py
+    tags = tag_leaderboard.top()
     return render_template('main/index.html', pagination=pagination, photos=photos, tags=tags)
 
 
 @main_bp.route('/explore')
 def explore():
-    """随机显示12张图片"""
-    photos = Photo.query.order_by(func.random()).limit(12)
+    """随机显示12张图片，图片从内存中定期采样的候选池中挑选，见albumy/explore.py"""
+    photos = explore_pool.photos(12)
     return render_template('main/explore.html', photos=photos)
 
 
@@ -55,26 +58,27 @@ def search():
     page = request.args.get('page', 1, type=int)
     per_page = current_app.config['ALBUMY_SEARCH_RESULT_PER_PAGE']
     if category == 'user':
-        pagination = User.query.whooshee_search(q).paginate(page, per_page)
+        pagination = search_page(User, q, page, per_page)
     elif category == 'tag':
-        pagination = Tag.query.whooshee_search(q).paginate(page, per_page)
+        pagination = search_page(Tag, q, page, per_page)
     else:
-        pagination = Photo.query.whooshee_search(q).paginate(page, per_page)
+        pagination = search_page(Photo, q, page, per_page)
     results = pagination.items
-    return render_template('main/search.html', q=q, results=results, pagination=pagination, category=category)
+    follow_states = current_user.follow_states([user.id for user in results]) if category == 'user' else {}
+    return render_template('main/search.html', q=q, results=results, pagination=pagination, category=category,
+                           follow_states=follow_states)
 
 
 @main_bp.route('/notifications')
 @login_required
 def show_notifications():
-    page = request.args.get('page', 1, type=int)
     per_page = current_app.config['ALBUMY_NOTIFICATION_PER_PAGE']
-    notifications = Notification.query.with_parent(current_user)
+    notifications = Notification.query.with_parent(current_user).options(joinedload(Notification.actor))
     filter_rule = request.args.get('filter')  # 获取消息过滤标签：all、unread
     if filter_rule == 'unread':
         notifications = notifications.filter_by(is_read=False)
 
-    pagination = notifications.order_by(Notification.timestamp.desc()).paginate(page, per_page)
+    pagination = keyset_paginate(notifications, Notification.timestamp, Notification.id, per_page=per_page)
     notifications = pagination.items
     return render_template('main/notifications.html', pagination=pagination, notifications=notifications)
 
@@ -87,8 +91,11 @@ def read_notification(notification_id):
     if current_user != notification.receiver:
         abort(403)
 
+    unread = not notification.is_read
     notification.is_read = True
     db.session.commit()
+    if unread:
+        add_unread_count(current_user.id, -1)
     flash('Notification archived.', 'success')
     return redirect(url_for('.show_notifications'))
 
@@ -97,23 +104,26 @@ def read_notification(notification_id):
 @login_required
 def read_all_notification():
     """将该用户的所有未读消息标记为已读"""
-    for notification in current_user.notifications:
-        notification.is_read = True
+    Notification.query.with_parent(current_user).filter_by(is_read=False) \
+        .update({'is_read': True}, synchronize_session=False)
     db.session.commit()
+    reset_unread_count(current_user.id)
     flash('All notifications archived.', 'success')
     return redirect(url_for('.show_notifications'))
 
 
 @main_bp.route('/uploads/<path:filename>')
 def get_image(filename):
-    """获取图片"""
-    return send_from_directory(current_app.config['ALBUMY_UPLOAD_PATH'], filename)
+    """获取图片，浏览器支持时返回体积更小的WebP或AVIF版本"""
+    response = send_upload(storage.photos, negotiate_image(storage.photos, filename))
+    response.vary.add('Accept')  # 同一URL的响应内容随Accept首部变化，缓存时需要区分
+    return response
 
 
 @main_bp.route('/avatars/<path:filename>')
 def get_avatar(filename):
     """获取头像文件"""
-    return send_from_directory(current_app.config['AVATARS_SAVE_PATH'], filename)
+    return send_upload(storage.avatars, filename)
 
 
 @main_bp.route('/upload', methods=['GET', 'POST'])
@@ -123,21 +133,41 @@ def get_avatar(filename):
 def upload():
     if request.method == 'POST' and 'file' in request.files:
         f = request.files.get('file')
-        filename = rename_image(f.filename)
-        f.save(os.path.join(current_app.config['ALBUMY_UPLOAD_PATH'], filename))
-        filename_s = resize_image(f, filename, current_app.config['ALBUMY_PHOTO_SIZE']['small'])
-        filename_m = resize_image(f, filename, current_app.config['ALBUMY_PHOTO_SIZE']['medium'])
+        if 'dzuuid' in request.form:  # Dropzone分块上传，收到最后一个分块后再保存
+            path = receive_chunk(current_user.id, f, request.form)
+            if path is None:
+                return '', 204
+            blob = store_file(path, f.filename)
+        else:
+            blob = store_upload(f.stream, f.filename)
+        # 已经上传过相同内容的图片时直接复用它的缩略图，否则在后台生成，生成完成前先使用原图
+        same = Photo.query.filter_by(blob_id=blob.id).first()
+        render = same is None or same.rendition_status == 'failed'
         photo = Photo(
-            filename=filename,
-            filename_s=filename_s,
-            filename_m=filename_m,
+            filename=blob.filename,
+            filename_s=blob.filename if render else same.filename_s,
+            filename_m=blob.filename if render else same.filename_m,
+            rendition_status='pending' if render else same.rendition_status,
+            blob=blob,
             author=current_user._get_current_object()  # 这里必须传入实际对象，不是代理对象
         )
         db.session.add(photo)
+        db.session.flush()  # 获取图片的id和上传时间
+        fan_out_photo(photo)
+        current_user.photos_count = User.photos_count + 1
         db.session.commit()
+        if render:
+            generate_thumbnails(photo)
     return render_template('main/upload.html')
 
 
+@main_bp.route('/upload/status/<upload_id>')
+@login_required
+def get_upload_status(upload_id):
+    """获取分块上传的进度"""
+    return jsonify(upload_status(current_user.id, upload_id))
+
+
 @main_bp.route('/photo/<int:photo_id>')
 def show_photo(photo_id):
     """显示图片详情页"""
@@ -242,11 +272,13 @@ def report_photo(photo_id):
 def show_collectors(photo_id):
     """返回收藏该图片的用户列表"""
     photo = Photo.query.get_or_404(photo_id)
-    page = request.args.get('page', 1, type=int)
     per_page = current_app.config['ALBUMY_USER_PER_PAGE']
-    pagination = Collect.query.with_parent(photo).order_by(Collect.timestamp.asc()).paginate(page, per_page)
+    pagination = keyset_paginate(Collect.query.with_parent(photo), Collect.timestamp, Collect.collector_id,
+                                 per_page=per_page, ascending=True, total=photo.collectors_count)
     collects = pagination.items
-    return redirect(url_for('main/collectors.html', collects=collects, photo=photo, pagination=pagination))
+    follow_states = current_user.follow_states([collect.collector_id for collect in collects])
+    return render_template('main/collectors.html', collects=collects, photo=photo, pagination=pagination,
+                           follow_states=follow_states)
 
 
 @main_bp.route('/photo/<int:photo_id>/description', methods=['POST'])
@@ -285,15 +317,16 @@ def new_comment(photo_id):
             comment.replied = Comment.query.get_or_404(replied_id)
             # 推送评论回复消息
             if comment.replied.author.receive_comment_notification:
-                push_comment_notification(photo_id=photo_id, receiver=comment.replied.author)
+                push_comment_notification(commenter=author, photo_id=photo_id, receiver=comment.replied.author)
 
         db.session.add(comment)
+        photo.comments_count = Photo.comments_count + 1
         db.session.commit()
         flash('Comment published.', 'success')
 
         # 推送新评论消息
         if current_user != photo.author and photo.author.receive_comment_notification:
-            push_comment_notification(photo_id=photo_id, receiver=photo.author, page=page)
+            push_comment_notification(commenter=author, photo_id=photo_id, receiver=photo.author)
 
     flash_errors(form)
     return redirect(url_for('.show_photo', photo_id=photo_id, page=page))
@@ -317,7 +350,9 @@ def new_tag(photo_id):
                 db.session.commit()
             if tag not in photo.tags:
                 photo.tags.append(tag)
+                tag.photos_count = Tag.photos_count + 1
                 db.session.commit()
+                tag_leaderboard.update(tag)
         flash('Tag added.', 'success')
 
     flash_errors(form)
@@ -362,8 +397,17 @@ def delete_photo(photo_id):
     if current_user != photo.author and not current_user.can('MODERATE'):
         abort(403)
 
+    # 图片删除后同步更新作者、标签和收藏者的计数器
+    photo.author.photos_count = User.photos_count - 1
+    tags = list(photo.tags)
+    for tag in tags:
+        tag.photos_count = Tag.photos_count - 1
+    User.query.filter(User.id.in_(db.session.query(Collect.collector_id).filter_by(collected_id=photo_id))) \
+        .update({User.collections_count: User.collections_count - 1}, synchronize_session=False)
     db.session.delete(photo)
     db.session.commit()
+    for tag in tags:
+        tag_leaderboard.update(tag)
     flash('Photo deleted.', 'info')
 
     photo_n = Photo.query.with_parent(photo.author).filter(Photo.id < photo_id).order_by(Photo.id.desc()).first()
@@ -383,6 +427,8 @@ def delete_comment(comment_id):
     if current_user != comment.author and current_user != comment.photo.author \
             and not current_user.can('MODERATE'):
         abort(403)
+    # 删除评论时会级联删除其下的所有回复，计数器需要减去整个评论树的数量
+    comment.photo.comments_count = Photo.comments_count - count_comment_thread(comment)
     db.session.delete(comment)
     db.session.commit()
     flash('Comment deleted.', 'info')
@@ -394,14 +440,14 @@ def delete_comment(comment_id):
 def show_tag(tag_id, order):
     """同一标签的图片列表页面，图片可按照时间（by_time）和收藏数量(by_collects)排序"""
     tag = Tag.query.get_or_404(tag_id)
-    page = request.args.get('page', 1, type=int)
     per_page = current_app.config['ALBUMY_PHOTO_PER_PAGE']
     order_rule = 'time'
-    pagination = Photo.query.with_parent(tag).order_by(Photo.timestamp.desc()).paginate(page, per_page)
+    pagination = keyset_paginate(Photo.query.with_parent(tag), Photo.timestamp, Photo.id,
+                                 per_page=per_page, total=tag.photos_count)
     photos = pagination.items
 
     if order == 'by_collects':
-        photos.sort(key=lambda x: len(x.collectors), reverse=True)
+        photos.sort(key=lambda x: x.collectors_count, reverse=True)
         order_rule = 'collects'
     return render_template('main/tag.html', tag=tag, pagination=pagination,
                            photos=photos, order_rule=order_rule)
@@ -416,12 +462,16 @@ def delete_tag(photo_id, tag_id):
     if current_user != photo.author and not current_user.can('MODERATE'):
         abort(403)
     photo.tags.remove(tag)
+    tag.photos_count = Tag.photos_count - 1
     db.session.commit()
 
     # 如果当前tag不再关联任何图片，则删除该tag
-    if not tag.photos:
+    if not tag.photos_count:
         db.session.delete(tag)
         db.session.commit()
+        tag_leaderboard.remove(tag_id)
+    else:
+        tag_leaderboard.update(tag)
 
     flash('Tag deleted.', 'info')
     return redirect(url_for('.show_photo', photo_id=photo_id))
@@ -1,3 +1,5 @@
+import os
+
 from flask import Blueprint, render_template, current_app, request, flash, redirect, url_for
 from flask_login import login_required, current_user, fresh_login_required, logout_user
 
@@ -6,9 +8,11 @@ from albumy.emails import send_confirm_email
 from albumy.extensions import db, avatars
 from albumy.forms.user import EditProfileForm, UploadAvatarForm, CropAvatarForm, ChangeEmailForm, \
     ChangePasswordForm, NotificationSettingForm, PrivacySettingForm, DeleteAccountForm
-from albumy.models import User, Photo, Collect
+from albumy.models import User, Photo, Collect, Follow
 from albumy.notifications import push_follow_notification
+from albumy.pagination import keyset_paginate
 from albumy.settings import Operations
+from albumy.storage import storage
 from albumy.utils import redirect_back, generate_token, validate_token, flash_errors
 
 user_bp = Blueprint('user', __name__)
@@ -24,9 +28,9 @@ def index(username):
     if user == current_user and not user.active:
         logout_user()  # 用户被封禁时，不允许登录
 
-    page = request.args.get('page', 1, type=int)
     per_page = current_app.config['ALBUMY_PHOTO_PER_PAGE']
-    pagination = Photo.query.with_parent(user).order_by(Photo.timestamp.desc()).paginate(page, per_page)
+    pagination = keyset_paginate(Photo.query.with_parent(user), Photo.timestamp, Photo.id,
+                                 per_page=per_page, total=user.photos_count)
     photos = pagination.items
     return render_template('user/index.html', user=user, pagination=pagination, photos=photos)
 
@@ -35,9 +39,9 @@ def index(username):
 def show_collections(username):
     """显示用户收藏的图片"""
     user = User.query.filter_by(username=username).first_or_404()
-    page = request.args.get('page', 1, type=int)
     per_page = current_app.config['ALBUMY_PHOTO_PER_PAGE']
-    pagination = Collect.query.with_parent(user).order_by(Collect.timestamp.desc()).paginate(page, per_page)
+    pagination = keyset_paginate(Collect.query.with_parent(user), Collect.timestamp, Collect.collected_id,
+                                 per_page=per_page, total=user.collections_count)
     collects = pagination.items
     return render_template('user/collections.html', user=user, pagination=pagination, collects=collects)
 
@@ -75,21 +79,25 @@ def unfollow(username):
 @user_bp.route('/<username>/followers')
 def show_followers(username):
     user = User.query.filter_by(username=username).first_or_404()
-    page = request.args.get('page', 1, type=int)
     per_page = current_app.config['ALBUMY_USER_PER_PAGE']
-    pagination = user.followers.paginate(page, per_page)
+    pagination = keyset_paginate(user.followers, Follow.timestamp, Follow.follower_id,
+                                 per_page=per_page, total=user.followers_count)
     follows = pagination.items
-    return render_template('user/followers.html', user=user, pagination=pagination, follows=follows)
+    follow_states = current_user.follow_states([follow.follower_id for follow in follows])
+    return render_template('user/followers.html', user=user, pagination=pagination, follows=follows,
+                           follow_states=follow_states)
 
 
 @user_bp.route('/<username>/following')
 def show_following(username):
     user = User.query.filter_by(username=username).first_or_404()
-    page = request.args.get('page', 1, type=int)
     per_page = current_app.config['ALBUMY_USER_PER_PAGE']
-    pagination = user.following.paginate(page, per_page)
+    pagination = keyset_paginate(user.following, Follow.timestamp, Follow.followed_id,
+                                 per_page=per_page, total=user.following_count)
     follows = pagination.items
-    return render_template('user/following.html', user=user, pagination=pagination, follows=follows)
+    follow_states = current_user.follow_states([follow.followed_id for follow in follows])
+    return render_template('user/following.html', user=user, pagination=pagination, follows=follows,
+                           follow_states=follow_states)
 
 
 @user_bp.route('/settings/profile', methods=['GET', 'POST'])
@@ -130,6 +138,7 @@ def upload_avatar():
     if form.validate_on_submit():
         image = form.image.data
         filename = avatars.save_avatar(image)  # 根据配置保存图片，并返回文件名
+        storage.avatars.save_file(filename, os.path.join(current_app.config['AVATARS_SAVE_PATH'], filename))
         current_user.avatar_raw = filename
         db.session.commit()
         flash('Image uploaded, please crop.', 'success')
@@ -148,7 +157,10 @@ def crop_avatar():
         w = form.w.data
         h = form.h.data
         # 裁剪图像，并返回不同大小的文件名称
-        filenames = avatars.crop_avatar(current_user.avatar_raw, x, y, w, h)
+        # 传入原始头像的绝对路径，裁剪后的文件由Flask-Avatars写入AVATARS_SAVE_PATH，再保存到头像存储中
+        filenames = avatars.crop_avatar(storage.avatars.path(current_user.avatar_raw), x, y, w, h)
+        for filename in filenames:
+            storage.avatars.save_file(filename, os.path.join(current_app.config['AVATARS_SAVE_PATH'], filename))
         current_user.avatar_s = filenames[0]
         current_user.avatar_m = filenames[1]
         current_user.avatar_l = filenames[2]
@@ -0,0 +1,164 @@
+import json
+import threading
+import time
+
+from flask import current_app
+
+try:
+    import redis
+except ImportError:  # 只有使用Redis缓存时才需要安装redis
+    redis = None
+
+
+class SimpleCache(object):
+    """进程内缓存，数据只在当前进程中可见，多进程部署时各进程的缓存互不同步"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._data = {}  # key -> (过期时间, 值)
+
+    def get(self, key):
+        entry = self._data.get(key)
+        if entry is None or entry[0] <= time.monotonic():
+            return None
+        return entry[1]
+
+    def set(self, key, value, timeout):
+        with self._lock:
+            self._data[key] = (time.monotonic() + timeout, value)
+            if len(self._data) > 10000:  # 清理过期的数据
+                now = time.monotonic()
+                self._data = {k: v for k, v in self._data.items() if v[0] > now}
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def incr(self, key, delta=1):
+        """把整数值加上delta并返回新值，键不存在或已过期时不做修改并返回None，不改变过期时间"""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[0] <= time.monotonic():
+                return None
+            self._data[key] = (entry[0], entry[1] + delta)
+            return entry[1] + delta
+
+    def get_json(self, key):
+        return self.get(key)
+
+    def set_json(self, key, value, timeout):
+        self.set(key, value, timeout)
+
+    def version(self, key):
+        return self.get(key) or 0
+
+    def bump_version(self, key, timeout):
+        """把版本号加一，键不存在或已过期时从1开始"""
+        with self._lock:
+            self._data[key] = (time.monotonic() + timeout, self.version(key) + 1)
+
+    def set_json_if_version(self, key, value, timeout, version_key, version):
+        with self._lock:
+            if self.version(version_key) == version:
+                self._data[key] = (time.monotonic() + timeout, value)
+
+
+class RedisCache(object):
+    """Redis缓存，多个进程和服务器共享"""
+
+    # 只在键存在时加上delta，避免在没有初始值的键上计数
+    _incr_script = "if redis.call('exists', KEYS[1]) == 1 then return redis.call('incrby', KEYS[1], ARGV[1]) end"
+    # 只在版本号没有变化时写入，检查和写入之间不会插入其他客户端的命令
+    _set_if_version_script = """
+if tonumber(redis.call('get', KEYS[2]) or '0') == tonumber(ARGV[1]) then
+    return redis.call('set', KEYS[1], ARGV[2], 'EX', ARGV[3])
+end"""
+
+    def __init__(self, url, prefix='albumy:'):
+        if redis is None:
+            raise RuntimeError('Redis cache requires redis, install it with "pip install redis".')
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+        self._incr = self.client.register_script(self._incr_script)
+        self._set_if_version = self.client.register_script(self._set_if_version_script)
+
+    def get(self, key):
+        value = self.client.get(self.prefix + key)
+        return None if value is None else int(value)
+
+    def set(self, key, value, timeout):
+        self.client.set(self.prefix + key, value, ex=timeout)
+
+    def delete(self, key):
+        self.client.delete(self.prefix + key)
+
+    def incr(self, key, delta=1):
+        return self._incr(keys=[self.prefix + key], args=[delta])
+
+    def get_json(self, key):
+        value = self.client.get(self.prefix + key)
+        return None if value is None else json.loads(value)
+
+    def set_json(self, key, value, timeout):
+        self.client.set(self.prefix + key, json.dumps(value), ex=timeout)
+
+    def version(self, key):
+        return self.get(key) or 0
+
+    def bump_version(self, key, timeout):
+        with self.client.pipeline() as pipe:
+            pipe.incr(self.prefix + key)
+            pipe.expire(self.prefix + key, timeout)
+            pipe.execute()
+
+    def set_json_if_version(self, key, value, timeout, version_key, version):
+        self._set_if_version(keys=[self.prefix + key, self.prefix + version_key],
+                             args=[version, json.dumps(value), timeout])
+
+
+class Cache(object):
+    """根据ALBUMY_CACHE_TYPE配置创建缓存后端：simple为进程内缓存，redis为REDIS_URL指定的Redis。
+    get、set和incr用于整数计数器，get_json和set_json用于可以序列化为JSON的数据。
+    version、bump_version和set_json_if_version用于带版本号的数据：修改数据时先增加版本号再删除缓存，
+    读取数据库前记下版本号，写回缓存时版本号已经变化说明期间发生过修改，放弃写入"""
+
+    def init_app(self, app):
+        if app.config['ALBUMY_CACHE_TYPE'] == 'redis':
+            backend = RedisCache(app.config['REDIS_URL'])
+        else:
+            backend = SimpleCache()
+        app.extensions['albumy_cache'] = backend
+
+    @property
+    def _backend(self):
+        return current_app.extensions['albumy_cache']
+
+    def get(self, key):
+        return self._backend.get(key)
+
+    def set(self, key, value, timeout):
+        self._backend.set(key, value, timeout)
+
+    def delete(self, key):
+        self._backend.delete(key)
+
+    def incr(self, key, delta=1):
+        return self._backend.incr(key, delta)
+
+    def get_json(self, key):
+        return self._backend.get_json(key)
+
+    def set_json(self, key, value, timeout):
+        self._backend.set_json(key, value, timeout)
+
+    def version(self, key):
+        return self._backend.version(key)
+
+    def bump_version(self, key, timeout):
+        self._backend.bump_version(key, timeout)
+
+    def set_json_if_version(self, key, value, timeout, version_key, version):
+        self._backend.set_json_if_version(key, value, timeout, version_key, version)
+
+
+cache = Cache()
@@ -1,27 +1,93 @@
-from threading import Thread
+from datetime import datetime, timedelta
 
 from flask import current_app, render_template
 from flask_mail import Message
+from sqlalchemy.orm import Session
 
-from albumy.extensions import mail
+from albumy.extensions import db, mail
+from albumy.models import MailMessage
+from albumy.tasks import BackgroundWorker
 
 
-def _send_async_mail(app, message):
-    with app.app_context():
-        mail.send(message)
+def send_mail(to, subject, template, **kwargs):
+    """把邮件写入发送队列，邮件内容在这里渲染，提交后由后台线程发送"""
+    message = MailMessage(recipient=to, subject=current_app.config['ALBUMY_MAIL_SUBJECT_PREFIX'] + subject,
+                          body=render_template(template + '.txt', **kwargs),  # 纯文本
+                          html=render_template(template + '.html', **kwargs))  # html
+    db.session.add(message)
+    db.session.info['send_mail'] = True
+    db.session.commit()
+    return message
 
 
-def send_mail(to, subject, template, **kwargs):
-    message = Message(current_app.config['ALBUMY_MAIL_SUBJECT_PREFIX'] + subject,
-                      recipients=[to])
-    # 纯文本
-    message.body = render_template(template + '.txt', **kwargs)
-    # html
-    message.html = render_template(template + '.html', **kwargs)
-    app = current_app._get_current_object()
-    thr = Thread(target=_send_async_mail, args=[app, message])
-    thr.start()
-    return thr
+def due_mail(session):
+    return session.query(MailMessage).filter(MailMessage.next_attempt <= datetime.utcnow(),
+                                             MailMessage.attempts < current_app.config['ALBUMY_MAIL_MAX_ATTEMPTS'])
+
+
+def _claim_mail(session, batch):
+    """领取一批到期的邮件：把它们的下次发送时间推迟ALBUMY_MAIL_LEASE秒，只有推迟成功的线程可以发送。
+    发送线程意外退出时，租约到期后邮件会被重新发送"""
+    lease = datetime.utcnow() + timedelta(seconds=current_app.config['ALBUMY_MAIL_LEASE'])
+    claimed = []
+    for id, next_attempt in due_mail(session).with_entities(MailMessage.id, MailMessage.next_attempt) \
+            .order_by(MailMessage.id).limit(batch):
+        if session.query(MailMessage).filter_by(id=id, next_attempt=next_attempt) \
+                .update({'next_attempt': lease}, synchronize_session=False):
+            claimed.append(id)
+    session.commit()
+    return session.query(MailMessage).filter(MailMessage.id.in_(claimed)).order_by(MailMessage.id).all()
+
+
+def _retry_later(message, error):
+    message.attempts += 1
+    message.last_error = repr(error)[:255]
+    delay = current_app.config['ALBUMY_MAIL_RETRY_DELAY'] * 2 ** (message.attempts - 1)
+    message.next_attempt = datetime.utcnow() + timedelta(seconds=min(delay, 24 * 3600))
+
+
+def send_queued_mail():
+    """通过同一个SMTP连接发送一批邮件，返回是否还有待发送的邮件。发送失败的邮件按指数退避重试。
+    使用独立的会话，可以在其他会话的after_commit事件中调用"""
+    batch = current_app.config['ALBUMY_MAIL_BATCH']
+    with Session(db.engine) as session:
+        messages = _claim_mail(session, batch)
+        if not messages:
+            return False
+        pending = list(reversed(messages))
+        try:
+            with mail.connect() as connection:
+                while pending:
+                    message = pending[-1]
+                    try:
+                        connection.send(Message(message.subject, recipients=[message.recipient],
+                                                body=message.body, html=message.html))
+                    except Exception as e:
+                        _retry_later(message, e)
+                    else:
+                        session.delete(message)
+                    pending.pop()
+        except Exception as e:  # 无法连接SMTP服务器
+            current_app.logger.error('Failed to connect to the mail server: %r', e)
+            for message in pending:
+                _retry_later(message, e)
+        session.commit()
+    return len(messages) == batch
+
+
+mail_sender = BackgroundWorker(send_queued_mail, 'ALBUMY_MAIL_INTERVAL', 'ALBUMY_MAIL_WORKERS')
+
+
+@db.event.listens_for(Session, 'after_commit')
+def wake_mail_sender(session):
+    """写入了邮件的事务提交后，立即唤醒发送线程"""
+    if session.info.pop('send_mail', False):
+        mail_sender.wake()
+
+
+@db.event.listens_for(Session, 'after_rollback')
+def discard_mail_flag(session):
+    session.info.pop('send_mail', None)
 
 
 def send_confirm_email(user, token, to=None):
@@ -0,0 +1,78 @@
+import itertools
+import random
+import threading
+import time
+
+from flask import current_app
+
+from albumy.extensions import db
+from albumy.models import Photo
+
+
+class ExplorePool(object):
+    """探索页的候选图片池：定期从数据库中采样一批图片id保存在内存中，每次请求只从池中随机挑选，
+    避免ORDER BY RANDOM()对整张photo表排序，单次请求的开销只与挑选的数量有关"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._ids = ()
+        self._cum_weights = None  # 按收藏数加权时的累积权重，不加权时为None
+        self._expires_at = 0
+
+    def refresh(self):
+        """重新采样候选池：图片较少时取全部图片，否则在id范围内随机取id进行采样"""
+        size = current_app.config['ALBUMY_EXPLORE_POOL_SIZE']
+        min_id, max_id = db.session.query(db.func.min(Photo.id), db.func.max(Photo.id)).one()
+        rows = {}
+        if min_id is not None:
+            if max_id - min_id < size:
+                query = db.session.query(Photo.id, Photo.collectors_count)
+                rows.update(query.all())
+            else:
+                # id可能因删除而不连续，每轮多取一些随机id，直到池被填满或达到最大轮数
+                for _ in range(5):
+                    missing = size - len(rows)
+                    if missing <= 0:
+                        break
+                    candidates = random.sample(range(min_id, max_id + 1), min(missing * 2, max_id - min_id + 1))
+                    for i in range(0, len(candidates), 500):  # 分批查询，避免超出SQL参数数量限制
+                        query = db.session.query(Photo.id, Photo.collectors_count) \
+                            .filter(Photo.id.in_(candidates[i:i + 500]))
+                        rows.update(query.all())
+        ids = tuple(itertools.islice(rows, size))
+        cum_weights = None
+        if current_app.config['ALBUMY_EXPLORE_WEIGHTED']:
+            cum_weights = list(itertools.accumulate(1 + rows[photo_id] for photo_id in ids))
+        # 一次性替换，正在挑选的请求仍使用旧的池
+        self._ids, self._cum_weights = ids, cum_weights
+        self._expires_at = time.monotonic() + current_app.config['ALBUMY_EXPLORE_POOL_TTL']
+
+    def sample(self, count):
+        """从候选池中随机挑选count个不重复的图片id，池过期时先重新采样"""
+        if time.monotonic() >= self._expires_at:
+            with self._lock:
+                if time.monotonic() >= self._expires_at:
+                    self.refresh()
+        ids, cum_weights = self._ids, self._cum_weights
+        if len(ids) <= count:
+            return list(ids)
+        if cum_weights is None:
+            return random.sample(ids, count)
+        chosen = set()
+        for _ in range(count * 10):  # 加权抽样可能重复抽中热门图片，限制尝试次数
+            chosen.add(random.choices(ids, cum_weights=cum_weights)[0])
+            if len(chosen) == count:
+                break
+        return list(chosen)
+
+    def photos(self, count):
+        """返回随机挑选的图片对象列表"""
+        photo_ids = self.sample(count)
+        if not photo_ids:
+            return []
+        photos = Photo.query.filter(Photo.id.in_(photo_ids)).all()
+        random.shuffle(photos)
+        return photos
+
+
+explore_pool = ExplorePool()
@@ -5,7 +5,6 @@ from flask_login import LoginManager, AnonymousUserMixin
 from flask_sqlalchemy import SQLAlchemy
 from flask_mail import Mail
 from flask_moment import Moment
-from flask_whooshee import Whooshee
 from flask_wtf import CSRFProtect
 
 avatars = Avatars()
@@ -16,15 +15,15 @@ login_manager = LoginManager()
 mail = Mail()
 moment = Moment()
 csrf = CSRFProtect()
-whooshee = Whooshee()
 
 
 @login_manager.user_loader
 def load_user(user_id):
-    """根据session中的user_id获取User对象"""
-    from albumy.models import User
-    user = User.query.get(int(user_id))
-    return user
+    """根据session中的user_id获取User对象，用户已被删除时返回None，退出登录。
+    用户的身份信息来自缓存的快照，通常不需要查询数据库"""
+    from albumy.identity import identity_cache
+    snapshot = identity_cache.get(int(user_id))
+    return None if snapshot is None else snapshot.to_user(db.session)
 
 
 login_manager.login_view = 'auth.login'  # 未登录用户跳转的登录视图
@@ -44,6 +43,9 @@ class Guest(AnonymousUserMixin):
     def can(self, permission_name):
         return False
 
+    def follow_states(self, user_ids):
+        return {}
+
     @property
     def is_admin(self):
         return False
@@ -1,13 +1,12 @@
-import os
 import random
 
 from PIL import Image
 from faker import Faker
-from flask import current_app
 from sqlalchemy.exc import IntegrityError
 
 from albumy.extensions import db
 from albumy.models import User, Photo, Tag, Comment, Notification, Role
+from albumy.storage import storage
 
 fake = Faker()
 
@@ -65,14 +64,15 @@ def fake_tag(count=20):
 
 def fake_photo(count=30):
     """生成纯色图片"""
-    upload_path = current_app.config['ALBUMY_UPLOAD_PATH']
     for i in range(count):
         print(i)
 
         filename = 'random_%d.jpg' % i
         r = lambda: random.randint(128, 255)
         img = Image.new(mode='RGB', size=(800, 800), color=(r(), r(), r()))
-        img.save(os.path.join(upload_path, filename))
+        path = storage.photos.staging_path(filename)
+        img.save(path)
+        storage.photos.save_file(filename, path)
 
         photo = Photo(
             description=fake.text(),
@@ -0,0 +1,145 @@
+import threading
+import time
+from collections import OrderedDict
+
+from flask import current_app
+from sqlalchemy.orm import Session, make_transient_to_detached, object_session
+
+from albumy.cache import cache
+from albumy.extensions import db
+from albumy.models import User
+
+
+class UserSnapshot(object):
+    """登录用户的身份快照，只保存每个请求都会用到的字段（导航栏的头像和用户名、权限判断需要的角色和状态）。
+    权限集合通过role_id从进程级的角色权限缓存获取，角色的权限变化时不需要更新每个用户的快照"""
+    __slots__ = ('id', 'username', 'name', 'avatar_s', 'avatar_m', 'role_id', 'confirmed', 'locked', 'active')
+
+    def __init__(self, *values):
+        for name, value in zip(self.__slots__, values):
+            setattr(self, name, value)
+
+    @classmethod
+    def load(cls, user_id):
+        """只查询快照需要的字段，用户不存在时返回None"""
+        row = db.session.query(*(getattr(User, name) for name in cls.__slots__)).filter(User.id == user_id).first()
+        return None if row is None else cls(*row)
+
+    def to_list(self):
+        return [getattr(self, name) for name in self.__slots__]
+
+    def to_user(self, session):
+        """把快照还原为会话中的User对象，不查询数据库。快照之外的字段和关系在第一次访问时才加载"""
+        key = db.inspect(User).identity_key_from_primary_key((self.id,))
+        user = session.identity_map.get(key)
+        if user is None:
+            user = User.__mapper__.class_manager.new_instance()  # 不调用User.__init__()
+            for name in self.__slots__:
+                setattr(user, name, getattr(self, name))
+            make_transient_to_detached(user)  # 未设置的字段标记为过期
+            session.add(user)
+        return user
+
+
+class IdentityCache(object):
+    """用户身份快照的缓存。ALBUMY_CACHE_TYPE为simple时使用进程内的LRU缓存，保存ALBUMY_IDENTITY_CACHE_TTL秒；
+    为redis时只使用Redis中的快照，多个进程共享，任何进程修改或删除用户后，下一个请求就会重新读取"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # user_id -> (过期时间, 快照)，按最近使用的顺序排列
+        self._version = 0  # 每次失效时加一，读取期间发生过失效的快照不写入缓存，避免缓存旧数据
+
+    @staticmethod
+    def _shared():
+        return current_app.config['ALBUMY_CACHE_TYPE'] == 'redis'
+
+    def get(self, user_id):
+        """返回用户的身份快照，用户不存在时返回None"""
+        if self._shared():
+            return self._get_shared(user_id)
+
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(user_id)
+                return entry[1]
+            version = self._version
+
+        snapshot = UserSnapshot.load(user_id)
+        if snapshot is None:
+            return None
+        with self._lock:
+            if self._version == version:
+                self._entries[user_id] = (now + current_app.config['ALBUMY_IDENTITY_CACHE_TTL'], snapshot)
+                self._entries.move_to_end(user_id)
+                while len(self._entries) > current_app.config['ALBUMY_IDENTITY_CACHE_SIZE']:
+                    self._entries.popitem(last=False)
+        return snapshot
+
+    @staticmethod
+    def _get_shared(user_id):
+        key, version_key = 'identity:%d' % user_id, 'identity-version:%d' % user_id
+        values = cache.get_json(key)
+        if values is not None and len(values) == len(UserSnapshot.__slots__):
+            return UserSnapshot(*values)
+
+        version = cache.version(version_key)  # 必须在查询数据库之前读取
+        snapshot = UserSnapshot.load(user_id)
+        if snapshot is not None:
+            cache.set_json_if_version(key, snapshot.to_list(), current_app.config['ALBUMY_IDENTITY_SHARED_TTL'],
+                                      version_key, version)
+        return snapshot
+
+    def invalidate(self, user_ids):
+        with self._lock:
+            self._version += 1
+            for user_id in user_ids:
+                self._entries.pop(user_id, None)
+        if self._shared():
+            for user_id in user_ids:
+                # 先增加版本号再删除快照，修改提交前开始读取的进程不能再把旧快照写回Redis
+                cache.bump_version('identity-version:%d' % user_id, current_app.config['ALBUMY_IDENTITY_SHARED_TTL'])
+                cache.delete('identity:%d' % user_id)
+
+    def clear(self):
+        """清空进程内缓存"""
+        with self._lock:
+            self._version += 1
+            self._entries.clear()
+
+
+identity_cache = IdentityCache()
+
+# 修改后需要使快照失效的属性，修改role关系时role_id可能在刷新时才同步
+_SNAPSHOT_ATTRS = UserSnapshot.__slots__ + ('role',)
+
+
+def _record_stale(target):
+    object_session(target).info.setdefault('stale_identities', set()).add(target.id)
+
+
+@db.event.listens_for(User, 'after_update')
+def _after_update(mapper, connection, target):
+    state = db.inspect(target)
+    if any(state.attrs[name].history.has_changes() for name in _SNAPSHOT_ATTRS):
+        _record_stale(target)
+
+
+@db.event.listens_for(User, 'after_delete')
+def _after_delete(mapper, connection, target):
+    _record_stale(target)
+
+
+@db.event.listens_for(Session, 'after_commit')
+def invalidate_identities(session):
+    """锁定、封禁、修改资料和角色等操作提交后，使对应用户的快照失效"""
+    user_ids = session.info.pop('stale_identities', None)
+    if user_ids:
+        identity_cache.invalidate(user_ids)
+
+
+@db.event.listens_for(Session, 'after_rollback')
+def discard_stale_identities(session):
+    session.info.pop('stale_identities', None)
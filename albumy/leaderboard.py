@@ -0,0 +1,96 @@
+import threading
+import time
+from collections import namedtuple
+
+from flask import current_app
+from sqlalchemy.orm import Session
+
+from albumy.extensions import db
+from albumy.models import Tag
+
+HotTag = namedtuple('HotTag', ['id', 'name', 'photos_count'])
+
+
+class TagLeaderboard(object):
+    """热门标签排行榜：在内存中维护使用次数最多的标签，添加或删除标签时增量更新，
+    首页侧边栏直接读取，不需要联结tagging表分组计数。
+
+    除了需要显示的ALBUMY_HOT_TAG_COUNT个标签外，还会多保存同样数量的候选标签，
+    这样排行榜中的标签使用次数减少时，通常可以直接用候选标签补位而无需重新查询"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = None  # 按使用次数降序排列的HotTag元组，None表示需要重新加载
+        self._complete = False  # 是否已经保存了所有使用中的标签
+        self._expires_at = 0
+
+    @property
+    def _capacity(self):
+        return current_app.config['ALBUMY_HOT_TAG_COUNT'] * 2
+
+    def _load(self):
+        rows = db.session.query(Tag.id, Tag.name, Tag.photos_count) \
+            .filter(Tag.photos_count > 0) \
+            .order_by(Tag.photos_count.desc(), Tag.id) \
+            .limit(self._capacity).all()
+        self._entries = tuple(HotTag(*row) for row in rows)
+        self._complete = len(rows) < self._capacity
+        # 其他进程的更新不会同步到本进程，过期后重新加载
+        self._expires_at = time.monotonic() + current_app.config['ALBUMY_HOT_TAG_TTL']
+
+    def top(self):
+        """返回最热门的标签列表"""
+        if self._entries is None or time.monotonic() >= self._expires_at:
+            with self._lock:
+                if self._entries is None or time.monotonic() >= self._expires_at:
+                    self._load()
+        return self._entries[:current_app.config['ALBUMY_HOT_TAG_COUNT']]
+
+    def update(self, tag):
+        """标签的使用次数变化后调用，tag.photos_count应为已提交的最新值"""
+        entry = HotTag(tag.id, tag.name, tag.photos_count)
+        with self._lock:
+            if self._entries is None:
+                return
+            entries = [item for item in self._entries if item.id != entry.id]
+            # 未保存的标签使用次数都不超过最后一名，所以只有不低于最后一名时才能确定该标签的排名
+            if entry.photos_count > 0 and \
+                    (self._complete or entries and entry.photos_count >= entries[-1].photos_count):
+                entries.append(entry)
+            self._replace(entries)
+
+    def remove(self, tag_id):
+        """标签被删除后调用"""
+        with self._lock:
+            if self._entries is not None:
+                self._replace([item for item in self._entries if item.id != tag_id])
+
+    def reset(self):
+        """批量修改标签的使用次数后调用，下次读取时重新加载"""
+        with self._lock:
+            self._entries = None
+
+    def _replace(self, entries):
+        entries.sort(key=lambda item: (-item.photos_count, item.id))
+        if len(entries) > self._capacity:
+            del entries[self._capacity:]
+            self._complete = False
+        if not self._complete and len(entries) < current_app.config['ALBUMY_HOT_TAG_COUNT']:
+            self._entries = None  # 候选标签不足以填满排行榜，下次读取时重新加载
+        else:
+            self._entries = tuple(entries)
+
+
+tag_leaderboard = TagLeaderboard()
+
+
+@db.event.listens_for(Session, 'after_commit')
+def reset_leaderboard(session):
+    """删除用户时批量减少了标签的使用次数，提交后重新加载排行榜"""
+    if session.info.pop('stale_tags', None):
+        tag_leaderboard.reset()
+
+
+@db.event.listens_for(Session, 'after_rollback')
+def discard_stale_tags(session):
+    session.info.pop('stale_tags', None)
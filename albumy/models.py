@@ -1,12 +1,16 @@
 import os
+from collections import namedtuple
 from datetime import datetime
 
 from flask import current_app
 from flask_avatars import Identicon
 from flask_login import UserMixin
+from sqlalchemy.orm import Session, object_session
 from werkzeug.security import generate_password_hash, check_password_hash
 
-from albumy.extensions import db, whooshee
+from albumy import paths
+from albumy.extensions import db
+from albumy.storage import storage
 
 # 关系表：Role和Permission之间是多对多关系，使用关系表建立联系
 roles_permissions = db.Table('roles_permissions',
@@ -14,6 +18,14 @@ roles_permissions = db.Table('roles_permissions',
                              db.Column('permission_id', db.Integer, db.ForeignKey('permission.id')))
 
 
+# 当前用户与另一个用户之间的关注状态：following表示当前用户正在关注对方，followed_by表示当前用户被对方关注
+FollowState = namedtuple('FollowState', ['following', 'followed_by'])
+
+# 进程级的角色权限缓存：role_id -> frozenset(权限名)。
+# 每次更新都替换为新的字典而不是原地修改，读取时无需加锁
+_role_permissions = {}
+
+
 class Permission(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(30), unique=True)
@@ -54,6 +66,26 @@ class Role(db.Model):
                     db.session.add(permission)
                 role.permissions.append(permission)
         db.session.commit()
+        Role.clear_permission_cache()
+
+    @staticmethod
+    def get_permissions(role_id):
+        """获取角色拥有的权限名集合，每个角色只在第一次使用时查询数据库"""
+        global _role_permissions
+        permissions = _role_permissions.get(role_id)
+        if permissions is None:
+            names = db.session.query(Permission.name) \
+                .join(roles_permissions, roles_permissions.c.permission_id == Permission.id) \
+                .filter(roles_permissions.c.role_id == role_id).all()
+            permissions = frozenset(name for name, in names)
+            _role_permissions = {**_role_permissions, role_id: permissions}
+        return permissions
+
+    @staticmethod
+    def clear_permission_cache():
+        """角色与权限的关系变化后，清空权限缓存"""
+        global _role_permissions
+        _role_permissions = {}
 
 
 class Collect(db.Model):
@@ -87,7 +119,6 @@ class Follow(db.Model):
     followed = db.relationship('User', foreign_keys=[followed_id], back_populates='followers', lazy='joined')
 
 
-@whooshee.register_model('name', 'username')
 class User(db.Model, UserMixin):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(20), unique=True, index=True)
@@ -113,12 +144,19 @@ class User(db.Model, UserMixin):
     receive_follow_notification = db.Column(db.Boolean, default=True, comment='接收关注消息开关')
     receive_collect_notification = db.Column(db.Boolean, default=True, comment='接收收藏消息开关')
 
+    # 计数器字段：冗余保存关系数量，避免渲染页面时为了计数加载全部关系记录，可通过flask recount命令重建
+    photos_count = db.Column(db.Integer, default=0, nullable=False, server_default='0', comment='上传图片数量')
+    collections_count = db.Column(db.Integer, default=0, nullable=False, server_default='0', comment='收藏图片数量')
+    followers_count = db.Column(db.Integer, default=0, nullable=False, server_default='0', comment='关注者数量')
+    following_count = db.Column(db.Integer, default=0, nullable=False, server_default='0', comment='正在关注的数量')
+
     role_id = db.Column(db.Integer, db.ForeignKey('role.id'))
     role = db.relationship('Role', back_populates='users')
 
     photos = db.relationship('Photo', back_populates='author', cascade='all')
     comments = db.relationship('Comment', back_populates='author', cascade='all')
-    notifications = db.relationship('Notification', back_populates='receiver', cascade='all')
+    notifications = db.relationship('Notification', back_populates='receiver', cascade='all',
+                                    foreign_keys='Notification.receiver_id')
     collections = db.relationship('Collect', back_populates='collector', cascade='all')
     following = db.relationship('Follow', foreign_keys=[Follow.follower_id], back_populates='follower',
                                 lazy='dynamic', cascade='all')  # 我正在关注的人
@@ -151,12 +189,21 @@ class User(db.Model, UserMixin):
         if not self.is_following(user):
             follow = Follow(follower=self, followed=user)
             db.session.add(follow)
+            from albumy.timeline import backfill_timeline
+            backfill_timeline(follower=self, followed=user)
+            # 使用SQL表达式自增，在同一事务中更新计数器，避免并发时的覆盖写
+            self.following_count = User.following_count + 1
+            user.followers_count = User.followers_count + 1
             db.session.commit()
 
     def unfollow(self, user):
         follow = self.following.filter_by(followed_id=user.id).first()
         if follow:
             db.session.delete(follow)
+            self.following_count = User.following_count - 1
+            user.followers_count = User.followers_count - 1
+            from albumy.timeline import prune_timeline
+            prune_timeline(follower=self, followed=user)
             db.session.commit()
 
     def is_following(self, user):
@@ -167,6 +214,19 @@ class User(db.Model, UserMixin):
     def is_followed_by(self, user):
         return self.followers.filter_by(follower_id=user.id).first() is not None
 
+    def follow_states(self, user_ids):
+        """批量获取当前用户与一组用户之间的双向关注状态，返回{user_id: FollowState}，
+        只使用一次IN查询，供用户列表页面代替逐个调用is_following()和is_followed_by()"""
+        user_ids = set(user_ids)
+        if not user_ids:
+            return {}
+        rows = db.session.query(Follow.follower_id, Follow.followed_id).filter(
+            db.or_(db.and_(Follow.follower_id == self.id, Follow.followed_id.in_(user_ids)),
+                   db.and_(Follow.followed_id == self.id, Follow.follower_id.in_(user_ids)))).all()
+        following = {followed_id for follower_id, followed_id in rows if follower_id == self.id}
+        followed_by = {follower_id for follower_id, followed_id in rows if followed_id == self.id}
+        return {user_id: FollowState(user_id in following, user_id in followed_by) for user_id in user_ids}
+
     @property
     def followed_photos(self):
         """获取关注用户的最新图片"""
@@ -178,12 +238,16 @@ class User(db.Model, UserMixin):
         if not self.is_collecting(photo):
             collect = Collect(collector=self, collected=photo)
             db.session.add(collect)
+            self.collections_count = User.collections_count + 1
+            photo.collectors_count = Photo.collectors_count + 1
             db.session.commit()
 
     def uncollect(self, photo):
         collect = Collect.query.with_parent(self).filter_by(collected_id=photo.id).first()
         if collect:
             db.session.delete(collect)
+            self.collections_count = User.collections_count - 1
+            photo.collectors_count = Photo.collectors_count - 1
             db.session.commit()
 
     def is_collecting(self, photo):
@@ -214,6 +278,8 @@ class User(db.Model, UserMixin):
         avatar = Identicon()
         # 生成三种尺寸的头像保存到AVATARS_SAVE_PATH，返回文件名
         filenames = avatar.generate(text=self.username)
+        for filename in filenames:  # 保存到头像存储中
+            storage.avatars.save_file(filename, os.path.join(current_app.config['AVATARS_SAVE_PATH'], filename))
         self.avatar_s = filenames[0]
         self.avatar_m = filenames[1]
         self.avatar_l = filenames[2]
@@ -222,7 +288,7 @@ class User(db.Model, UserMixin):
     @property
     def is_admin(self):
         """判断用户是否为管理员"""
-        return self.role.name == 'Administrator'
+        return self.can('ADMINISTER')
 
     @property
     def is_active(self):
@@ -230,9 +296,8 @@ class User(db.Model, UserMixin):
         return self.active
 
     def can(self, permission_name):
-        """判断用户是否具有某项权限"""
-        permission = Permission.query.filter_by(name=permission_name).first()
-        return permission and self.role and permission in self.role.permissions
+        """判断用户是否具有某项权限，权限集合来自进程级缓存，不会查询数据库"""
+        return self.role_id is not None and permission_name in Role.get_permissions(self.role_id)
 
 
 # photo与tag之间的多对多关系表
@@ -241,7 +306,6 @@ tagging = db.Table('tagging',
                    db.Column('tag_id', db.Integer, db.ForeignKey('tag.id')))
 
 
-@whooshee.register_model('description')
 class Photo(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     description = db.Column(db.String(500))
@@ -250,19 +314,41 @@ class Photo(db.Model):
     filename_m = db.Column(db.String(64), comment='中等尺寸缩略图文件名，800px')
     timestamp = db.Column(db.DateTime, default=datetime.utcnow, index=True)
     can_comment = db.Column(db.Boolean, default=True, comment='图片能否评论')
-    flag = db.Column(db.Integer, default=0, comment='图片被举报次数计数器')
+    flag = db.Column(db.Integer, default=0, nullable=False, server_default='0', comment='图片被举报次数计数器')
     author_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    collectors_count = db.Column(db.Integer, default=0, nullable=False, server_default='0', comment='被收藏次数')
+    comments_count = db.Column(db.Integer, default=0, nullable=False, server_default='0', comment='评论数量')
+    # 缩略图在后台生成，生成完成前filename_s和filename_m都指向原图
+    rendition_status = db.Column(db.String(10), default='ready', nullable=False, server_default='ready',
+                                 comment='缩略图状态：pending生成中，ready已生成，failed生成失败')
+    # 内容相同的图片共用同一个文件，为空表示按内容寻址存储之前上传的图片
+    blob_id = db.Column(db.String(64), db.ForeignKey('blob.id'), index=True)
+    # 上传时是否已写入关注者的时间线；为False的图片在读取时间线时实时查询，与作者现在的关注者数量无关
+    fanned_out = db.Column(db.Boolean, default=False, nullable=False, server_default=db.false())
 
     author = db.relationship('User', back_populates='photos')
+    blob = db.relationship('Blob')
     comments = db.relationship('Comment', back_populates='photo', cascade='all')
     collectors = db.relationship('Collect', back_populates='collected', cascade='all')
     tags = db.relationship('Tag', secondary=tagging, back_populates='photos')
 
+    # 读取时间线时按作者查询未写扩散的图片
+    __table_args__ = (db.Index('ix_photo_author_fanned_out_timestamp', 'author_id', 'fanned_out', 'timestamp'),)
+
+
+class Blob(db.Model):
+    """按内容寻址保存的上传文件，id为文件内容的SHA-256，内容相同的图片只保存一份文件和缩略图"""
+    id = db.Column(db.String(64), primary_key=True)
+    filename = db.Column(db.String(128), comment='原图文件名，ab/cd/<sha256>.<ext>')
+    refcount = db.Column(db.Integer, default=0, nullable=False, server_default='0', comment='引用该文件的图片数量')
+    timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+
 
-@whooshee.register_model('name')
 class Tag(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(64), index=True, unique=True)
+    photos_count = db.Column(db.Integer, default=0, nullable=False, server_default='0', index=True,
+                             comment='使用该标签的图片数量')
 
     photos = db.relationship('Photo', secondary=tagging, back_populates='tags')
 
@@ -271,7 +357,7 @@ class Comment(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     body = db.Column(db.Text)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow, index=True)
-    flag = db.Column(db.Integer, default=0, comment='评论被举报次数计数器')
+    flag = db.Column(db.Integer, default=0, nullable=False, server_default='0', comment='评论被举报次数计数器')
 
     # 外键：被回复的评论的id, 本评论的用户id， 被评论的图片的id
     replied_id = db.Column(db.Integer, db.ForeignKey('comment.id'))
@@ -285,32 +371,201 @@ class Comment(db.Model):
 
 
 class Notification(db.Model):
+    """消息：kind、actor_id和target_id保存消息的内容，在显示时渲染；同一时间段内相同的消息合并为一条，
+    如“Alice and 41 others collected your photo”"""
     id = db.Column(db.Integer, primary_key=True)
-    message = db.Column(db.Text, nullable=False)
+    message = db.Column(db.Text, comment='系统消息的HTML内容，kind为空时使用')
+    kind = db.Column(db.String(20), comment='消息类型：follow、comment或collect')
+    target_id = db.Column(db.Integer, comment='消息相关的图片id')
+    actor_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='SET NULL'), comment='最近一个触发消息的用户')
+    actors_count = db.Column(db.Integer, default=1, nullable=False, server_default='1', comment='合并的用户数量')
     is_read = db.Column(db.Boolean, default=False)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow, index=True)
 
     receiver_id = db.Column(db.Integer, db.ForeignKey('user.id'))
 
-    receiver = db.relationship('User', back_populates='notifications')
+    receiver = db.relationship('User', back_populates='notifications', foreign_keys=[receiver_id])
+    actor = db.relationship('User', foreign_keys=[actor_id])
+    actors = db.relationship('NotificationActor', cascade='all, delete-orphan')
+
+    # 用于查询未读消息数量、按时间分页列出未读消息和全部标记为已读
+    __table_args__ = (db.Index('ix_notification_receiver_read_timestamp', 'receiver_id', 'is_read', 'timestamp', 'id'),)
+
+
+class Timeline(db.Model):
+    """物化的首页时间线（写扩散）：用户上传图片时，为作者的每个关注者写入一条记录，
+    首页只需按(user_id, timestamp)索引顺序读取，无需每次联结Photo和Follow表"""
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    photo_id = db.Column(db.Integer, db.ForeignKey('photo.id'), primary_key=True)
+    timestamp = db.Column(db.DateTime, nullable=False, comment='冗余保存的图片上传时间，用于排序')
+
+    __table_args__ = (db.Index('ix_timeline_user_timestamp', 'user_id', 'timestamp', 'photo_id'),)
+
+
+class NotificationActor(db.Model):
+    """合并到消息中的用户，用于按不同的用户计数：同一用户多次收藏同一图片时只计一次"""
+    notification_id = db.Column(db.Integer, db.ForeignKey('notification.id', ondelete='CASCADE'), primary_key=True)
+    actor_id = db.Column(db.Integer, primary_key=True)
+
+
+class NotificationEvent(db.Model):
+    """待写入的消息事件：关注、评论、收藏时写入，由后台任务合并后批量写入Notification表"""
+    id = db.Column(db.Integer, primary_key=True)
+    receiver_id = db.Column(db.Integer, nullable=False, index=True)
+    kind = db.Column(db.String(20), nullable=False)
+    actor_id = db.Column(db.Integer, nullable=False)
+    target_id = db.Column(db.Integer)
+    timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+    # 接收者最早的事件作为该接收者的锁，保存租约的到期时间，为空表示没有被后台任务领取
+    claimed_until = db.Column(db.DateTime)
+
+
+class MailMessage(db.Model):
+    """待发送的邮件：内容在写入时渲染，由后台线程通过同一个SMTP连接批量发送，发送成功后删除"""
+    id = db.Column(db.Integer, primary_key=True)
+    recipient = db.Column(db.String(254), nullable=False)
+    subject = db.Column(db.String(255), nullable=False)
+    body = db.Column(db.Text)
+    html = db.Column(db.Text)
+    attempts = db.Column(db.Integer, default=0, nullable=False, server_default='0', comment='已尝试发送的次数')
+    next_attempt = db.Column(db.DateTime, default=datetime.utcnow, index=True, comment='下次尝试发送的时间')
+    last_error = db.Column(db.String(255))
+    timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+
+
+class Tombstone(db.Model):
+    """待删除的文件：删除图片或用户时在同一事务中写入，事务回滚时随之撤销，提交后由后台任务批量删除文件"""
+    id = db.Column(db.Integer, primary_key=True)
+    storage = db.Column(db.String(10), nullable=False, comment='文件所在的存储：photos或avatars')
+    filename = db.Column(db.String(128), nullable=False)
+    attempts = db.Column(db.Integer, default=0, nullable=False, server_default='0', comment='已尝试删除的次数')
+    next_attempt = db.Column(db.DateTime, default=datetime.utcnow, index=True, comment='下次尝试删除的时间')
+    last_error = db.Column(db.String(255))
+    timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+
+
+class SearchOutbox(db.Model):
+    """待更新全文索引的记录：由触发器在写入用户、图片和标签的事务中添加，后台任务批量更新索引后删除"""
+    id = db.Column(db.Integer, primary_key=True)
+    source = db.Column(db.String(20), nullable=False, comment='记录所在的表：user、photo或tag')
+    record_id = db.Column(db.Integer, nullable=False)
+
+
+def bury_files(target, connection, storage_name, filenames):
+    """在当前事务中为文件写入删除记录，并在提交后唤醒后台删除任务"""
+    rows = [{'storage': storage_name, 'filename': filename} for filename in filenames if filename]
+    if rows:
+        connection.execute(Tombstone.__table__.insert(), rows)
+        object_session(target).info['reap_files'] = True
+
+
+def rebuild_counters():
+    """使用关联子查询批量重建所有计数器字段，用于修正计数偏差或为已有数据初始化计数"""
+    def count_of(column, parent_column):
+        return db.select([db.func.count()]).where(column == parent_column).scalar_subquery()
+
+    db.session.query(User).update({
+        User.photos_count: count_of(Photo.author_id, User.id),
+        User.collections_count: count_of(Collect.collector_id, User.id),
+        User.followers_count: count_of(Follow.followed_id, User.id),
+        User.following_count: count_of(Follow.follower_id, User.id),
+    }, synchronize_session=False)
+    db.session.query(Photo).update({
+        Photo.collectors_count: count_of(Collect.collected_id, Photo.id),
+        Photo.comments_count: count_of(Comment.photo_id, Photo.id),
+        Photo.flag: db.func.coalesce(Photo.flag, 0),  # 管理页面按flag进行键集分页，不能为空
+    }, synchronize_session=False)
+    db.session.query(Comment).update({
+        Comment.flag: db.func.coalesce(Comment.flag, 0),
+    }, synchronize_session=False)
+    db.session.query(Tag).update({
+        Tag.photos_count: count_of(tagging.c.tag_id, Tag.id),
+    }, synchronize_session=False)
+    db.session.query(Blob).update({
+        Blob.refcount: count_of(Photo.blob_id, Blob.id),
+    }, synchronize_session=False)
+    db.session.commit()
+
+
+@db.event.listens_for(User, 'before_delete', named=True)
+def delete_user_timeline(**kwargs):
+    """删除用户前，删除该用户的时间线记录"""
+    kwargs['connection'].execute(Timeline.__table__.delete().where(Timeline.user_id == kwargs['target'].id))
+
+
+def _subtract_counts(session, column, key, from_obj, condition):
+    """把column减去from_obj中满足condition且key等于该行id的记录数量，只更新存在这样记录的行"""
+    table = column.table
+    count = db.select([db.func.count()]).select_from(from_obj).where(condition, key == table.c.id).scalar_subquery()
+    session.execute(table.update()
+                    .where(table.c.id.in_(db.select([key]).select_from(from_obj).where(condition)))
+                    .values({column: column - count}))
+
+
+@db.event.listens_for(Session, 'before_flush')
+def subtract_deleted_user_counts(session, flush_context, instances):
+    """删除用户时级联删除的关注、收藏、图片和评论不经过视图中的计数器更新，在删除前同步减少其他记录的计数器。
+    级联删除的记录在User的before_delete事件之前就已删除，所以在刷新前查询"""
+    follow, collect, photo, tag = Follow.__table__, Collect.__table__, Photo.__table__, Tag.__table__
+    for user_id in [obj.id for obj in session.deleted if isinstance(obj, User)]:
+        _subtract_counts(session, User.__table__.c.followers_count, follow.c.followed_id, follow,
+                         follow.c.follower_id == user_id)
+        _subtract_counts(session, User.__table__.c.following_count, follow.c.follower_id, follow,
+                         follow.c.followed_id == user_id)
+        _subtract_counts(session, photo.c.collectors_count, collect.c.collected_id, collect,
+                         collect.c.collector_id == user_id)
+        # 其他用户对该用户图片的收藏，以及该用户图片使用的标签
+        photo_collects = collect.join(photo, collect.c.collected_id == photo.c.id)
+        _subtract_counts(session, User.__table__.c.collections_count, collect.c.collector_id, photo_collects,
+                         photo.c.author_id == user_id)
+        photo_tags = tagging.join(photo, tagging.c.photo_id == photo.c.id)
+        tag_ids = {row[0] for row in session.execute(
+            db.select([tagging.c.tag_id]).select_from(photo_tags).where(photo.c.author_id == user_id))}
+        _subtract_counts(session, tag.c.photos_count, tagging.c.tag_id, photo_tags, photo.c.author_id == user_id)
+        session.info.setdefault('stale_tags', set()).update(tag_ids)
+        # 该用户的评论及其下所有回复（包括其他用户的回复）都会被删除
+        thread = db.select([Comment.id, Comment.photo_id]).where(Comment.author_id == user_id) \
+            .cte('thread', recursive=True)
+        thread = thread.union(db.select([Comment.id, Comment.photo_id]).where(Comment.replied_id == thread.c.id))
+        _subtract_counts(session, photo.c.comments_count, thread.c.photo_id, thread, db.true())
+
+
+@db.event.listens_for(Session, 'after_flush')
+def delete_unused_tags(session, flush_context):
+    """删除用户后，删除不再被任何图片使用的标签"""
+    tag_ids = session.info.get('stale_tags')
+    if tag_ids:
+        session.execute(Tag.__table__.delete().where(
+            Tag.id.in_(tag_ids), Tag.photos_count <= 0,
+            ~db.exists().where(tagging.c.tag_id == Tag.id)))
+
+
+@db.event.listens_for(Photo, 'before_delete', named=True)
+def delete_photo_timeline(**kwargs):
+    """删除图片前，从所有关注者的时间线中移除该图片"""
+    kwargs['connection'].execute(Timeline.__table__.delete().where(Timeline.photo_id == kwargs['target'].id))
 
 
 @db.event.listens_for(User, 'after_delete', named=True)
 def delete_avatars(**kwargs):
-    """监听用户注销，删除用户后，自动删除用户头像文件图片"""
+    """监听用户注销，删除用户后，自动删除用户头像文件图片（用户如果没自定义图像，avatar_raw则为空）"""
     target = kwargs['target']
-    for filename in [target.avatar_s, target.avatar_m, target.avatar_l, target.avatar_raw]:
-        if filename is not None:  # 用户如果没自定义图像，avatar_raw则为空
-            path = os.path.join(current_app.config['AVATARS_SAVE_PATH'], filename)
-            if os.path.exists(path):
-                os.remove(path)
+    bury_files(target, kwargs['connection'], 'avatars',
+               [target.avatar_s, target.avatar_m, target.avatar_l, target.avatar_raw])
 
 
 @db.event.listens_for(Photo, 'after_delete', named=True)
 def delete_photo(**kwargs):
     """监听数据库事件，当Photo模型中记录被删除时，到图片目录下删除对应文件"""
     target = kwargs['target']  # 获取photo对象
-    for filename in [target.filename, target.filename_s, target.filename_m]:
-        path = os.path.join(current_app.config['ALBUMY_UPLOAD_PATH'], filename)
-        if os.path.exists(path):  # 验证文件是否存在，因为小图片不会生成缩略图
-            os.remove(path)
+    if target.blob_id is not None:
+        # 减少文件的引用计数，仍有其他图片引用该文件时保留文件
+        blob = Blob.__table__
+        connection = kwargs['connection']
+        connection.execute(blob.update().where(blob.c.id == target.blob_id).values(refcount=blob.c.refcount - 1))
+        if connection.execute(db.select([blob.c.refcount]).where(blob.c.id == target.blob_id)).scalar():
+            return
+        connection.execute(blob.delete().where(blob.c.id == target.blob_id))
+    # 同时删除WebP等格式的版本，不存在的文件会被忽略（小图片不会生成缩略图）
+    bury_files(target, kwargs['connection'], 'photos',
+               paths.with_variants([target.filename, target.filename_s, target.filename_m]))
@@ -1,33 +1,177 @@
-from flask import url_for
+import json
+from collections import Counter
+from datetime import datetime, timedelta
 
+from flask import current_app
+from sqlalchemy.orm import Session
+
+from albumy.cache import cache
 from albumy.extensions import db
-from albumy.models import Notification
+from albumy.models import Notification, NotificationActor, NotificationEvent, User
+from albumy.pubsub import pubsub
+from albumy.tasks import BackgroundWorker
+
+
+def _unread_key(user_id):
+    return 'unread-notifications:%d' % user_id
+
+
+def notification_channel(user_id):
+    """用户的消息推送频道，订阅者会收到count（未读消息数量）和notification（新消息）事件"""
+    return 'notifications:%d' % user_id
+
+
+def publish_event(user_id, event, data):
+    pubsub.publish(notification_channel(user_id), json.dumps({'event': event, 'data': data}))
+
+
+def unread_count(user_id, session=None):
+    """返回用户的未读消息数量，缓存中没有时查询数据库并缓存ALBUMY_NOTIFICATION_COUNT_TTL秒"""
+    count = cache.get(_unread_key(user_id))
+    if count is None:
+        count = (session or db.session).query(Notification).filter_by(receiver_id=user_id, is_read=False).count()
+        cache.set(_unread_key(user_id), count, current_app.config['ALBUMY_NOTIFICATION_COUNT_TTL'])
+    return count
+
+
+def add_unread_count(user_id, delta):
+    """在消息写入或标记为已读的事务提交后更新未读消息数量，并推送给订阅的客户端"""
+    count = cache.incr(_unread_key(user_id), delta)
+    if count is None:  # 缓存中没有时重新查询；可能在其他会话的after_commit事件中调用，使用独立的会话
+        with Session(db.engine) as session:
+            count = unread_count(user_id, session)
+    publish_event(user_id, 'count', {'count': count})
+
+
+def reset_unread_count(user_id):
+    """所有消息都已标记为已读"""
+    cache.set(_unread_key(user_id), 0, current_app.config['ALBUMY_NOTIFICATION_COUNT_TTL'])
+    publish_event(user_id, 'count', {'count': 0})
+
+
+def prune_notifications(before):
+    """分批删除before之前收到的已读消息，返回删除的数量。每批单独提交，避免长时间锁表"""
+    batch = current_app.config['ALBUMY_NOTIFICATION_PRUNE_BATCH']
+    deleted = 0
+    while True:
+        ids = [id for id, in db.session.query(Notification.id).filter_by(is_read=True)
+               .filter(Notification.timestamp < before).limit(batch)]
+        if not ids:
+            return deleted
+        NotificationActor.query.filter(NotificationActor.notification_id.in_(ids)).delete(synchronize_session=False)
+        Notification.query.filter(Notification.id.in_(ids)).delete(synchronize_session=False)
+        db.session.commit()
+        deleted += len(ids)
+
+
+def _push_notification(kind, actor, receiver, target_id=None):
+    """写入消息事件，提交后由后台任务合并写入"""
+    db.session.add(NotificationEvent(kind=kind, actor_id=actor.id, receiver_id=receiver.id, target_id=target_id))
+    db.session.info['write_notifications'] = True
+    db.session.commit()
 
 
 def push_follow_notification(follower, receiver):
     """有新关注者时推送消息"""
-    message = 'User <a href="%s">%s</a> followed you.' % \
-              (url_for('user.index', username=follower.username), follower.username)
-    notification = Notification(message=message, receiver=receiver)
-    db.session.add(notification)
-    db.session.commit()
+    _push_notification('follow', follower, receiver)
 
 
-def push_comment_notification(photo_id, receiver, page=1):
+def push_comment_notification(commenter, photo_id, receiver):
     """有新评论或回复时推送消息"""
-    message = '<a href="%s#comments">This photo</a> has new comment/reply.' % \
-              (url_for('main.show_photo', photo_id=photo_id, page=page))
-    notification = Notification(message=message, receiver=receiver)
-    db.session.add(notification)
-    db.session.commit()
+    _push_notification('comment', commenter, receiver, photo_id)
 
 
 def push_collect_notification(collector, photo_id, receiver):
     """有用户收藏图片时推送消息"""
-    message = 'User <a href="%s">%s</a> collected your <a href="%s">photo</a>' % \
-              (url_for('user.index', username=collector.username),
-               collector.username,
-               url_for('main.show_photo', photo_id=photo_id))
-    notification = Notification(message=message, receiver=receiver)
-    db.session.add(notification)
-    db.session.commit()
+    _push_notification('collect', collector, receiver, photo_id)
+
+
+def _claim_receivers(session, batch):
+    """领取一批接收者：每个接收者最早的待处理事件作为该接收者的锁，把它的claimed_until推迟ALBUMY_NOTIFICATION_LEASE秒，
+    只有推迟成功的线程可以处理这个接收者的事件。同一接收者的事件不会被多个线程（或进程）同时合并，
+    不会重复写入消息或重复计数；线程意外退出时，租约到期后由其他线程重新处理"""
+    now = datetime.utcnow()
+    lease = now + timedelta(seconds=current_app.config['ALBUMY_NOTIFICATION_LEASE'])
+    heads = session.query(db.func.min(NotificationEvent.id)).group_by(NotificationEvent.receiver_id)
+    claimed = {}  # 接收者id -> 锁事件id
+    for id, receiver_id, claimed_until in session.query(NotificationEvent.id, NotificationEvent.receiver_id,
+                                                        NotificationEvent.claimed_until) \
+            .filter(NotificationEvent.id.in_(heads.scalar_subquery()),
+                    db.or_(NotificationEvent.claimed_until.is_(None), NotificationEvent.claimed_until <= now)) \
+            .order_by(NotificationEvent.id).limit(batch):
+        if session.query(NotificationEvent).filter_by(id=id, claimed_until=claimed_until) \
+                .update({'claimed_until': lease}, synchronize_session=False):
+            claimed[receiver_id] = id
+    session.commit()
+    return claimed
+
+
+def write_notifications():
+    """把一批消息事件写入消息表，返回是否还有待处理的事件。
+    同一接收者、同一类型和同一图片的事件合并为一条；ALBUMY_NOTIFICATION_COALESCE_WINDOW秒内
+    已有相同的未读消息时合并到该消息中，只更新最近的用户、用户数量和时间。
+    使用独立的会话，可以在其他会话的after_commit事件中调用"""
+    batch = current_app.config['ALBUMY_NOTIFICATION_BATCH']
+    since = datetime.utcnow() - timedelta(seconds=current_app.config['ALBUMY_NOTIFICATION_COALESCE_WINDOW'])
+    created, updated = Counter(), []
+    with Session(db.engine) as session:
+        claimed = _claim_receivers(session, batch)
+        if not claimed:
+            return False
+        events = session.query(NotificationEvent).filter(NotificationEvent.receiver_id.in_(list(claimed))) \
+            .order_by(NotificationEvent.id).limit(batch).all()
+        groups = {}
+        for event in events:
+            groups.setdefault((event.receiver_id, event.kind, event.target_id), []).append(event)
+        receivers = {id for id, in session.query(User.id).filter(User.id.in_(list(claimed)))}
+        for (receiver_id, kind, target_id), group in groups.items():
+            if receiver_id not in receivers:  # 接收者已被删除
+                continue
+            notification = session.query(Notification) \
+                .filter_by(receiver_id=receiver_id, is_read=False, kind=kind, target_id=target_id) \
+                .filter(Notification.timestamp >= since) \
+                .order_by(Notification.timestamp.desc()).first()
+            actors = {event.actor_id for event in group}
+            if notification is None:
+                notification = Notification(receiver_id=receiver_id, kind=kind, target_id=target_id, actors_count=0)
+                session.add(notification)
+                session.flush()  # 获取新消息的id
+                created[receiver_id] += 1
+            else:  # 按不同的用户计数，已经合并到消息中的用户不重复计数
+                actors -= {actor_id for actor_id, in session.query(NotificationActor.actor_id).filter(
+                    NotificationActor.notification_id == notification.id, NotificationActor.actor_id.in_(actors))}
+            session.add_all(NotificationActor(notification_id=notification.id, actor_id=actor_id) for actor_id in actors)
+            notification.actors_count += len(actors)
+            notification.actor_id = group[-1].actor_id
+            notification.timestamp = group[-1].timestamp
+            updated.append(notification)
+        published = [(notification.receiver_id, {
+            'id': notification.id, 'kind': notification.kind, 'target_id': notification.target_id,
+            'actor_id': notification.actor_id, 'actors_count': notification.actors_count
+        }) for notification in updated]
+        session.query(NotificationEvent).filter(NotificationEvent.id.in_([event.id for event in events])) \
+            .delete(synchronize_session=False)
+        # 超出本批数量、没有处理完的接收者释放锁，下一批立即处理
+        session.query(NotificationEvent).filter(NotificationEvent.id.in_(list(claimed.values()))) \
+            .update({'claimed_until': None}, synchronize_session=False)
+        session.commit()
+    for receiver_id, data in published:
+        publish_event(receiver_id, 'notification', data)
+    for receiver_id, count in created.items():
+        add_unread_count(receiver_id, count)
+    return len(claimed) == batch or len(events) == batch
+
+
+notification_writer = BackgroundWorker(write_notifications, 'ALBUMY_NOTIFICATION_INTERVAL')
+
+
+@db.event.listens_for(Session, 'after_commit')
+def start_notification_writer(session):
+    """写入了消息事件的事务提交后，确保后台任务已经启动，消息按ALBUMY_NOTIFICATION_INTERVAL的间隔批量写入"""
+    if session.info.pop('write_notifications', False):
+        notification_writer.start()
+
+
+@db.event.listens_for(Session, 'after_rollback')
+def discard_notification_flag(session):
+    session.info.pop('write_notifications', None)
@@ -0,0 +1,109 @@
+import base64
+import json
+from datetime import date, datetime
+
+from flask import current_app, request, url_for
+
+from albumy.extensions import db
+
+
+def encode_cursor(values):
+    """把排序键的值编码为不透明的游标字符串"""
+    values = [value.isoformat() if isinstance(value, (date, datetime)) else value for value in values]
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor, columns):
+    """根据排序字段的类型解析游标，游标无效时返回None，即从第一页开始"""
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode())
+        if not isinstance(values, list) or len(values) != len(columns):
+            return None
+        return [_load(column, value) for column, value in zip(columns, values)]
+    except (ValueError, TypeError, UnicodeError):
+        return None
+
+
+def _load(column, value):
+    python_type = column.type.python_type
+    if issubclass(python_type, datetime):
+        return datetime.fromisoformat(value)
+    if issubclass(python_type, date):
+        return date.fromisoformat(value)
+    return python_type(value)
+
+
+def after_cursor(columns, values, ascending=False):
+    """键集分页条件：按columns排序时排在values之后的记录，即(c1, c2, ...) < (v1, v2, ...)"""
+    clauses = []
+    for i, column in enumerate(columns):
+        equals = [columns[j] == values[j] for j in range(i)]
+        compare = column > values[i] if ascending else column < values[i]
+        clauses.append(db.and_(*equals, compare))
+    return db.or_(*clauses)
+
+
+class KeysetPagination(object):
+    """基于游标（键集）的分页对象，通过?after=游标翻页，不使用OFFSET，也不需要COUNT查询"""
+
+    def __init__(self, items, per_page, cursor=None, next_cursor=None, total=None, approximate=False):
+        self.items = items
+        self.per_page = per_page
+        self.cursor = cursor  # 当前页使用的游标，第一页为None
+        self.next_cursor = next_cursor
+        self.total = total  # 总数，来自计数器字段或有上限的计数，未知时为None
+        self.approximate = approximate  # total是否为截断后的近似值
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def is_first(self):
+        return self.cursor is None
+
+    def url_for_cursor(self, cursor=None):
+        """生成当前视图指定游标位置的URL，保留其他查询参数"""
+        args = request.args.to_dict()
+        args.pop('after', None)
+        args.pop('page', None)
+        if cursor is not None:
+            args['after'] = cursor
+        args.update(request.view_args)
+        return url_for(request.endpoint, **args)
+
+    @property
+    def first_url(self):
+        return self.url_for_cursor()
+
+    @property
+    def next_url(self):
+        return self.url_for_cursor(self.next_cursor)
+
+
+def keyset_paginate(query, *columns, per_page, ascending=False, total=None, approximate=False):
+    """按columns（如Photo.timestamp, Photo.id）对查询进行游标分页，最后一个字段必须能唯一确定记录顺序。
+    total可以直接传入计数器字段的值；approximate为True时执行一次有上限的计数，避免全表COUNT"""
+    cursor = request.args.get('after')
+    values = decode_cursor(cursor, columns) if cursor else None
+    if values is None:
+        cursor = None
+    if approximate and total is None:
+        cap = current_app.config['ALBUMY_PAGINATION_COUNT_CAP']
+        total = query.order_by(None).limit(cap + 1).count()
+        approximate = total > cap
+        total = min(total, cap)
+    else:
+        approximate = False
+
+    if values is not None:
+        query = query.filter(after_cursor(columns, values, ascending))
+    order = [column.asc() if ascending else column.desc() for column in columns]
+    # 多取一条记录，用于判断是否存在下一页
+    items = query.order_by(None).order_by(*order).limit(per_page + 1).all()
+    next_cursor = None
+    if len(items) > per_page:
+        items = items[:per_page]
+        next_cursor = encode_cursor([getattr(items[-1], column.key) for column in columns])
+    return KeysetPagination(items, per_page, cursor=cursor, next_cursor=next_cursor,
+                            total=total, approximate=approximate)
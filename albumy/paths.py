@@ -0,0 +1,79 @@
+import hashlib
+import os
+import re
+
+from flask import current_app
+
+# 缩略图、头像等文件名的尺寸后缀，去掉后缀后同一图片的所有文件会被映射到同一个目录
+_suffix = re.compile(r'_(s|m|l|raw)$')
+_hex = re.compile(r'^[0-9a-f]+$')
+
+
+def base_name(filename):
+    """去掉扩展名和尺寸后缀的文件名，同一图片的原图、缩略图和各格式版本相同"""
+    return _suffix.sub('', os.path.splitext(filename)[0])
+
+
+def shard(filename, levels=None):
+    """把数据库中保存的文件名映射为分片后的相对路径，如<sha256>.jpg -> ab/cd/<sha256>.jpg。
+    文件名本身是十六进制（uuid、SHA-256）时直接使用它的前缀，否则使用文件名的MD5；
+    已经包含目录的文件名（早期按内容寻址保存的图片）原样返回"""
+    if levels is None:
+        levels = current_app.config['ALBUMY_UPLOAD_FANOUT']
+    if levels == 0 or '/' in filename:
+        return filename
+    stem = base_name(filename)
+    key = stem if _hex.match(stem) and len(stem) >= levels * 2 else hashlib.md5(stem.encode()).hexdigest()
+    return '/'.join([key[i * 2:i * 2 + 2] for i in range(levels)] + [filename])
+
+
+def resolve(directory, filename):
+    """返回文件相对于directory的实际路径：优先使用分片路径，不存在时回退到迁移前的扁平路径"""
+    path = shard(filename)
+    if path != filename and not os.path.exists(os.path.join(directory, path)) \
+            and os.path.exists(os.path.join(directory, filename)):
+        return filename
+    return path
+
+
+def prepare(directory, filename):
+    """返回新文件应写入的绝对路径，并创建所需的分片目录"""
+    path = os.path.join(directory, shard(filename))
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    return path
+
+
+def with_variants(filenames):
+    """返回图片文件及其WebP等格式版本的文件名集合"""
+    filenames = set(filenames)
+    return filenames | {os.path.splitext(filename)[0] + ext for filename in filenames
+                        for ext in current_app.config['ALBUMY_PHOTO_VARIANTS'].values()}
+
+
+def misplaced(directory, exclude=()):
+    """遍历directory，生成所有不在分片路径上的文件(当前相对路径, 目标相对路径)，exclude中的子目录不遍历"""
+    for root, dirs, files in os.walk(directory):
+        dirs[:] = [name for name in dirs if os.path.join(root, name) not in exclude]
+        for filename in files:
+            if filename.endswith('.part'):  # 正在上传的临时文件
+                continue
+            current = os.path.relpath(os.path.join(root, filename), directory).replace(os.sep, '/')
+            target = shard(filename)
+            if current != target:
+                yield current, target
+
+
+def move_files(directory, moves):
+    """把一批文件移动到目标路径，返回移动的文件数量。目标已存在时保留目标，跳过该文件"""
+    moved = 0
+    for current, target in moves:
+        source, destination = os.path.join(directory, current), os.path.join(directory, target)
+        if os.path.exists(destination):
+            continue
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        try:
+            os.replace(source, destination)
+        except FileNotFoundError:  # 已被其他进程移动或删除
+            continue
+        moved += 1
+    return moved
@@ -0,0 +1,107 @@
+import os
+import queue
+import threading
+import time
+
+from flask import current_app
+
+try:
+    import redis
+except ImportError:  # 只有使用Redis发布订阅时才需要安装redis
+    redis = None
+
+
+class LocalPubSub(object):
+    """进程内的发布订阅，只能把消息发送给同一进程中的订阅者"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscribers = {}  # 频道 -> 订阅者队列的集合
+
+    def subscribe(self, channel):
+        """订阅频道，返回接收消息的队列；订阅者处理过慢、队列已满时丢弃新消息"""
+        subscriber = queue.Queue(maxsize=100)
+        with self._lock:
+            self._subscribers.setdefault(channel, set()).add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, channel, subscriber):
+        with self._lock:
+            subscribers = self._subscribers.get(channel)
+            if subscribers is not None:
+                subscribers.discard(subscriber)
+                if not subscribers:
+                    del self._subscribers[channel]
+
+    def publish(self, channel, message):
+        with self._lock:
+            subscribers = list(self._subscribers.get(channel, ()))
+        for subscriber in subscribers:
+            try:
+                subscriber.put_nowait(message)
+            except queue.Full:
+                pass
+
+
+class RedisPubSub(LocalPubSub):
+    """通过Redis在多个进程和服务器之间发布消息。每个进程只使用一个Redis连接订阅所有频道，
+    收到消息后再分发给本进程中的订阅者"""
+
+    def __init__(self, url, prefix='albumy:'):
+        if redis is None:
+            raise RuntimeError('Redis pub/sub requires redis, install it with "pip install redis".')
+        super(RedisPubSub, self).__init__()
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+        self._pid = None
+
+    def subscribe(self, channel):
+        # 监听线程在第一次订阅时才启动；fork出的子进程中没有父进程的线程，需要重新启动
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    threading.Thread(target=self._listen, name='redis_pubsub', daemon=True).start()
+                    self._pid = os.getpid()
+        return super(RedisPubSub, self).subscribe(channel)
+
+    def publish(self, channel, message):
+        self.client.publish(self.prefix + channel, message)
+
+    def _listen(self):
+        while True:
+            try:
+                pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+                pubsub.psubscribe(self.prefix + '*')
+                for item in pubsub.listen():
+                    channel = item['channel'].decode()[len(self.prefix):]
+                    super(RedisPubSub, self).publish(channel, item['data'].decode())
+            except redis.RedisError:  # 连接断开，稍后重新订阅，期间的消息会丢失
+                time.sleep(1)
+
+
+class PubSub(object):
+    """根据ALBUMY_PUBSUB_TYPE配置创建发布订阅后端：local为进程内，redis为REDIS_URL指定的Redis。
+    多进程部署时需要使用redis，否则只有连接到同一进程的客户端能收到消息"""
+
+    def init_app(self, app):
+        if app.config['ALBUMY_PUBSUB_TYPE'] == 'redis':
+            backend = RedisPubSub(app.config['REDIS_URL'])
+        else:
+            backend = LocalPubSub()
+        app.extensions['albumy_pubsub'] = backend
+
+    @property
+    def _backend(self):
+        return current_app.extensions['albumy_pubsub']
+
+    def subscribe(self, channel):
+        return self._backend.subscribe(channel)
+
+    def unsubscribe(self, channel, subscriber):
+        self._backend.unsubscribe(channel, subscriber)
+
+    def publish(self, channel, message):
+        self._backend.publish(channel, message)
+
+
+pubsub = PubSub()
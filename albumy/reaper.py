@@ -0,0 +1,94 @@
+from datetime import datetime, timedelta
+
+from flask import current_app
+from sqlalchemy.orm import Session
+
+from albumy import paths
+from albumy.extensions import db
+from albumy.models import Tombstone, Blob, Photo, User
+from albumy.storage import storage
+from albumy.tasks import BackgroundWorker
+
+
+def referenced_files(session, storage_name, filenames):
+    """返回仍被使用的文件名：删除记录写入后，相同的文件名可能又被新上传的图片或新注册的用户使用"""
+    if storage_name == 'avatars':
+        columns = [User.avatar_s, User.avatar_m, User.avatar_l, User.avatar_raw]
+        rows = session.query(*columns).filter(db.or_(*[column.in_(filenames) for column in columns]))
+        return {filename for row in rows for filename in row} & set(filenames)
+    columns = [Photo.filename, Photo.filename_s, Photo.filename_m]
+    rows = session.query(*columns).filter(db.or_(*[column.in_(filenames) for column in columns]))
+    used = {filename for row in rows for filename in row}
+    blobs = {blob_id for blob_id, in session.query(Blob.id).filter(
+        Blob.id.in_({paths.base_name(filename) for filename in filenames}))}
+    return {filename for filename in filenames if filename in used or paths.base_name(filename) in blobs}
+
+
+def guard_files(session, storage_name, filenames):
+    """在写入session事务引用的新文件之前调用：用独立的事务写入延迟ALBUMY_REAPER_GUARD_DELAY秒执行的删除记录。
+    session的事务提交后撤销这些记录；事务回滚时文件没有被引用，到期后由后台任务删除"""
+    next_attempt = datetime.utcnow() + timedelta(seconds=current_app.config['ALBUMY_REAPER_GUARD_DELAY'])
+    with Session(db.engine) as guard:
+        tombstones = [Tombstone(storage=storage_name, filename=filename, next_attempt=next_attempt)
+                      for filename in filenames]
+        guard.add_all(tombstones)
+        guard.flush()
+        session.info.setdefault('guarded_files', []).extend(tombstone.id for tombstone in tombstones)
+        guard.commit()
+
+
+def due_tombstones(session):
+    return session.query(Tombstone).filter(Tombstone.next_attempt <= datetime.utcnow(),
+                                           Tombstone.attempts < current_app.config['ALBUMY_REAPER_MAX_ATTEMPTS'])
+
+
+def reap_files():
+    """删除一批到期的文件，返回是否还有待处理的删除记录。删除失败的文件按指数退避重试。
+    使用独立的会话，可以在其他会话的after_commit事件中调用"""
+    batch = current_app.config['ALBUMY_REAPER_BATCH']
+    with Session(db.engine) as session:
+        tombstones = due_tombstones(session).order_by(Tombstone.id).limit(batch).all()
+        used = {}
+        for storage_name in {tombstone.storage for tombstone in tombstones}:
+            used[storage_name] = referenced_files(session, storage_name, [
+                tombstone.filename for tombstone in tombstones if tombstone.storage == storage_name])
+        now = datetime.utcnow()
+        for tombstone in tombstones:
+            if tombstone.filename not in used[tombstone.storage]:
+                try:
+                    getattr(storage, tombstone.storage).delete(tombstone.filename)
+                except Exception as e:
+                    tombstone.attempts += 1
+                    tombstone.last_error = repr(e)[:255]
+                    delay = current_app.config['ALBUMY_REAPER_RETRY_DELAY'] * 2 ** (tombstone.attempts - 1)
+                    tombstone.next_attempt = now + timedelta(seconds=min(delay, 24 * 3600))
+                    continue
+            session.delete(tombstone)
+        session.commit()
+    return len(tombstones) == batch
+
+
+file_reaper = BackgroundWorker(reap_files, 'ALBUMY_REAPER_INTERVAL')
+
+
+@db.event.listens_for(Session, 'after_commit')
+def wake_file_reaper(session):
+    """写入了删除记录的事务提交后，唤醒后台删除任务"""
+    if session.info.pop('reap_files', False):
+        file_reaper.wake()
+
+
+@db.event.listens_for(Session, 'after_commit')
+def cancel_guards(session):
+    """引用新文件的事务已经提交，撤销guard_files()写入的删除记录；撤销失败时记录到期后也会因文件仍被引用而跳过"""
+    ids = session.info.pop('guarded_files', None)
+    if ids:
+        with Session(db.engine) as guard:
+            guard.query(Tombstone).filter(Tombstone.id.in_(ids)).delete(synchronize_session=False)
+            guard.commit()
+
+
+@db.event.listens_for(Session, 'after_rollback')
+def discard_reap_flag(session):
+    session.info.pop('reap_files', None)
+    session.info.pop('guarded_files', None)
@@ -0,0 +1,223 @@
+import re
+import threading
+import time
+from collections import OrderedDict
+
+from flask import current_app, abort
+from flask_sqlalchemy import Pagination
+from sqlalchemy import column, func, literal_column, table
+from sqlalchemy.orm import Session, object_session
+
+from albumy.extensions import db
+from albumy.models import User, Photo, Tag, SearchOutbox
+from albumy.tasks import BackgroundWorker
+
+# 可以搜索的模型及其建立全文索引的列
+SEARCH_FIELDS = {
+    User: ('name', 'username'),
+    Photo: ('description',),
+    Tag: ('name',)
+}
+
+_term = re.compile(r'\w+')
+
+
+def index_name(model):
+    return model.__tablename__ + '_fts'
+
+
+def fts_enabled(bind=None):
+    """是否使用SQLite FTS5全文索引，其他数据库使用LIKE查询，不建立索引"""
+    return (bind or db.engine).dialect.name == 'sqlite'
+
+
+def _index_ddl(model):
+    """返回模型的FTS5索引表和记录待更新索引的触发器的建表语句。
+    触发器只向search_outbox写入记录的id，由后台任务批量更新索引；
+    更新时只在索引的列被修改时执行，更新计数器等其他列时不会触发"""
+    name, source, fields = index_name(model), model.__tablename__, SEARCH_FIELDS[model]
+    outbox = "INSERT INTO search_outbox(source, record_id) VALUES ('%s', %%s.id);" % source
+    return [
+        "CREATE VIRTUAL TABLE IF NOT EXISTS %s USING fts5(%s, tokenize='unicode61 remove_diacritics 2', "
+        "prefix='2 3')" % (name, ', '.join(fields)),
+        'DROP TRIGGER IF EXISTS %s_insert' % name,
+        'DROP TRIGGER IF EXISTS %s_update' % name,
+        'DROP TRIGGER IF EXISTS %s_delete' % name,
+        'CREATE TRIGGER %s_insert AFTER INSERT ON "%s" BEGIN %s END' % (name, source, outbox % 'new'),
+        'CREATE TRIGGER %s_update AFTER UPDATE OF %s ON "%s" BEGIN %s END'
+        % (name, ', '.join(fields), source, outbox % 'new'),
+        'CREATE TRIGGER %s_delete AFTER DELETE ON "%s" BEGIN %s END' % (name, source, outbox % 'old'),
+    ]
+
+
+def create_index(connection):
+    """创建全文索引表，并重新创建触发器，使已有数据库中的触发器与当前定义一致"""
+    if not fts_enabled(connection):
+        return
+    for model in SEARCH_FIELDS:
+        for statement in _index_ddl(model):
+            connection.exec_driver_sql(statement)
+
+
+@db.event.listens_for(db.metadata, 'after_create')
+def _create_index(target, connection, **kw):
+    create_index(connection)
+
+
+@db.event.listens_for(db.metadata, 'before_drop')
+def _drop_index(target, connection, **kw):
+    if fts_enabled(connection):
+        for model in SEARCH_FIELDS:
+            connection.exec_driver_sql('DROP TABLE IF EXISTS %s' % index_name(model))
+
+
+def apply_outbox():
+    """把search_outbox中的一批记录更新到索引中，返回是否还有待处理的记录。
+    索引中的记录用表中的当前数据替换，已删除的记录从索引中删除，同一记录的多次修改只更新一次。
+    使用独立的会话，可以在其他会话的after_commit事件中调用"""
+    batch = current_app.config['ALBUMY_SEARCH_INDEX_BATCH']
+    with Session(db.engine) as session:
+        ids = [id for id, in session.query(SearchOutbox.id).order_by(SearchOutbox.id).limit(batch)]
+        if not ids:
+            return False
+        connection = session.connection()
+        for model, fields in SEARCH_FIELDS.items():
+            name, source, columns = index_name(model), model.__tablename__, ', '.join(fields)
+            changed = 'SELECT record_id FROM search_outbox WHERE source = ? AND id <= ?'
+            connection.exec_driver_sql('DELETE FROM %s WHERE rowid IN (%s)' % (name, changed), (source, ids[-1]))
+            connection.exec_driver_sql('INSERT INTO %s(rowid, %s) SELECT id, %s FROM "%s" WHERE id IN (%s)'
+                                       % (name, columns, columns, source, changed), (source, ids[-1]))
+        session.query(SearchOutbox).filter(SearchOutbox.id <= ids[-1]).delete(synchronize_session=False)
+        session.commit()
+    return len(ids) == batch
+
+
+search_indexer = BackgroundWorker(apply_outbox, 'ALBUMY_SEARCH_INDEX_INTERVAL')
+
+
+def _mark_changed(mapper, connection, target):
+    session = object_session(target)
+    if session is not None:
+        session.info['search_outbox'] = True
+
+
+for _model in SEARCH_FIELDS:
+    for _event in ('after_insert', 'after_update', 'after_delete'):
+        db.event.listen(_model, _event, _mark_changed)
+
+
+@db.event.listens_for(Session, 'after_commit')
+def start_search_indexer(session):
+    """修改了可搜索记录的事务提交后，确保后台索引任务已经启动。
+    不立即唤醒，索引按ALBUMY_SEARCH_INDEX_INTERVAL的间隔批量更新"""
+    if session.info.pop('search_outbox', False) and fts_enabled():
+        search_indexer.start()
+
+
+@db.event.listens_for(Session, 'after_rollback')
+def discard_search_flag(session):
+    session.info.pop('search_outbox', None)
+
+
+def reindex(incremental=False):
+    """重建全文索引，返回{索引表名: 写入的记录数}。
+    incremental为True时先处理search_outbox中积压的记录，再补充索引中缺少的记录并删除已不存在的记录，
+    用于触发器创建之前已有的数据；否则清空后重新写入所有记录，并合并索引的b-tree段"""
+    create_index(db.session.connection())
+    db.session.commit()
+    if incremental:
+        while apply_outbox():
+            pass
+    else:
+        SearchOutbox.query.delete()
+    connection = db.session.connection()
+    counts = {}
+    for model, fields in SEARCH_FIELDS.items():
+        name, source, columns = index_name(model), model.__tablename__, ', '.join(fields)
+        if incremental:
+            connection.exec_driver_sql('DELETE FROM %s WHERE rowid NOT IN (SELECT id FROM "%s")' % (name, source))
+            where = ' WHERE id NOT IN (SELECT rowid FROM %s)' % name
+        else:
+            connection.exec_driver_sql('DELETE FROM %s' % name)
+            where = ''
+        result = connection.exec_driver_sql('INSERT INTO %s(rowid, %s) SELECT id, %s FROM "%s"%s'
+                                            % (name, columns, columns, source, where))
+        if not incremental:
+            connection.exec_driver_sql("INSERT INTO %s(%s) VALUES ('optimize')" % (name, name))
+        counts[name] = result.rowcount
+    db.session.commit()
+    search_cache.clear()
+    return counts
+
+
+def search_query(model, q):
+    """返回搜索q的查询，按相关度（BM25）排序。q中的每个词都需要匹配，并且作为前缀匹配，
+    如“sun”可以匹配“sunset”；q中的引号、运算符等特殊字符被忽略"""
+    terms = normalize_query(q).split()
+    if not terms:
+        return model.query.filter(db.false())
+    if not fts_enabled():
+        conditions = [db.or_(*[func.lower(getattr(model, field)).contains(term, autoescape=True)
+                               for field in SEARCH_FIELDS[model]]) for term in terms]
+        return model.query.filter(*conditions).order_by(model.id.desc())
+    search_indexer.start()
+    name = index_name(model)
+    index = table(name, column('rowid'))
+    match = ' '.join('"%s"*' % term for term in terms)
+    return model.query.join(index, index.c.rowid == model.id) \
+        .filter(literal_column(name).op('MATCH')(match)) \
+        .order_by(func.bm25(literal_column(name)), model.id.desc())
+
+
+def normalize_query(q):
+    """返回规范化的搜索词，只是大小写、空白或特殊字符不同的搜索词结果相同"""
+    return ' '.join(_term.findall(q.lower()))
+
+
+class SearchCache(object):
+    """搜索结果的LRU缓存：以(类别, 规范化的搜索词)为键保存按相关度排序的结果id，翻页时直接切片，
+    不需要重新执行全文查询和COUNT。结果在ALBUMY_SEARCH_CACHE_TTL秒后过期，
+    最多保存ALBUMY_SEARCH_CACHE_SIZE个搜索词"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (过期时间, id元组)，按最近使用的顺序排列
+
+    def get(self, key, load):
+        """返回缓存的id元组，不存在或已过期时调用load()获取并缓存"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(key)
+                return entry[1]
+        ids = tuple(load())
+        with self._lock:
+            self._entries[key] = (now + current_app.config['ALBUMY_SEARCH_CACHE_TTL'], ids)
+            self._entries.move_to_end(key)
+            while len(self._entries) > current_app.config['ALBUMY_SEARCH_CACHE_SIZE']:
+                self._entries.popitem(last=False)
+        return ids
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+search_cache = SearchCache()
+
+
+def search_page(model, q, page, per_page):
+    """返回搜索结果的分页对象，最多返回ALBUMY_SEARCH_MAX_RESULTS个结果"""
+    if page < 1:
+        abort(404)
+    ids = search_cache.get((model.__tablename__, normalize_query(q)),
+                           lambda: (id for id, in search_query(model, q).with_entities(model.id)
+                                    .limit(current_app.config['ALBUMY_SEARCH_MAX_RESULTS'])))
+    page_ids = ids[(page - 1) * per_page:page * per_page]
+    if not page_ids and page != 1:
+        abort(404)
+    items = {item.id: item for item in model.query.filter(model.id.in_(page_ids))} if page_ids else {}
+    # 缓存期间被删除的记录不再显示
+    return Pagination(None, page, per_page, len(ids), [items[id] for id in page_ids if id in items])
+
@@ -1,5 +1,6 @@
 import os
 import sys
+import tempfile
 
 basedir = os.path.abspath(os.path.dirname(os.path.dirname(__file__)))
 
@@ -28,17 +29,85 @@ class BaseConfig(object):
     ALBUMY_MANAGE_TAG_PER_PAGE = 50
     ALBUMY_MANAGE_COMMENT_PER_PAGE = 30
     ALBUMY_SEARCH_RESULT_PER_PAGE = 20
+    ALBUMY_EXPLORE_POOL_SIZE = 1000  # 探索页候选图片池的大小
+    ALBUMY_EXPLORE_POOL_TTL = 300  # 候选池重新采样的间隔（秒）
+    ALBUMY_EXPLORE_WEIGHTED = False  # 是否按收藏数加权挑选图片
+    ALBUMY_PAGINATION_COUNT_CAP = 1000  # 游标分页计算近似总数时的计数上限，超过时显示为1000+
+    ALBUMY_HOT_TAG_COUNT = 10  # 首页侧边栏显示的热门标签数量
+    ALBUMY_HOT_TAG_TTL = 60  # 热门标签排行榜重新加载的间隔（秒），用于同步其他进程的更新
     ALBUMY_MAIL_SUBJECT_PREFIX = '[Albumy]'
+    ALBUMY_MAIL_WORKERS = 2  # 每个进程中发送邮件的线程数量，即最多同时使用的SMTP连接数量
+    ALBUMY_MAIL_BATCH = 20  # 每个SMTP连接一次发送的邮件数量
+    ALBUMY_MAIL_INTERVAL = 60  # 检查待发送和需要重试的邮件的间隔（秒）
+    ALBUMY_MAIL_LEASE = 300  # 邮件被领取后的发送时限（秒），超时未发送完成时由其他线程重新发送
+    ALBUMY_MAIL_RETRY_DELAY = 60  # 发送失败后首次重试的等待时间（秒），之后每次翻倍
+    ALBUMY_MAIL_MAX_ATTEMPTS = 8  # 超过该次数后不再重试，通过flask send-mail查看
+    # 关注者数量超过该值的用户上传图片时不写入关注者的时间线，而是在读取首页时实时查询（读扩散）
+    ALBUMY_TIMELINE_FANOUT_LIMIT = 1000
+    ALBUMY_TIMELINE_BACKFILL = 100  # 关注用户时回填到时间线中的最近图片数量
     ALBUMY_UPLOAD_PATH = os.path.join(basedir, 'uploads')
+    ALBUMY_CHUNK_PATH = os.path.join(basedir, 'uploads-partial')  # 分块上传的临时文件目录
+    ALBUMY_CHUNK_SIZE = 2 * 1024 * 1024  # 分块上传时每个分块的大小，需要小于MAX_CONTENT_LENGTH
+    ALBUMY_CHUNK_TTL = 24 * 3600  # 未完成的分块上传保留的时间（秒），过期后由flask clean-uploads删除
+    ALBUMY_MAX_UPLOAD_SIZE = 50 * 1024 * 1024  # 分块上传的单个文件大小上限
+    ALBUMY_UPLOAD_FANOUT = 2  # 上传文件和头像的分片目录层数，每层两位十六进制，0表示不分片
+    ALBUMY_TASK_WORKERS = int(os.getenv('ALBUMY_TASK_WORKERS', 2))  # 后台任务进程池（缩略图生成等）的进程数
+    ALBUMY_TASK_ASYNC = True  # 为False时后台任务在请求中同步执行
+    ALBUMY_REAPER_INTERVAL = 60  # 后台删除文件任务的检查间隔（秒）
+    ALBUMY_REAPER_BATCH = 500  # 每批删除的文件数量
+    ALBUMY_REAPER_RETRY_DELAY = 60  # 删除失败后首次重试的等待时间（秒），之后每次翻倍
+    ALBUMY_REAPER_MAX_ATTEMPTS = 8  # 超过该次数后不再重试，通过flask reap-files --dry-run查看
+    ALBUMY_REAPER_GUARD_DELAY = 3600  # 上传的事务回滚后，已保存的文件在该时间（秒）后被删除，需要长于上传请求的处理时间
+    # 全文索引的更新间隔（秒），搜索结果最多延迟这么久；每批更新的记录数量
+    ALBUMY_SEARCH_INDEX_INTERVAL = 5
+    ALBUMY_SEARCH_INDEX_BATCH = 1000
+    ALBUMY_SEARCH_CACHE_SIZE = 256  # 缓存结果的搜索词数量
+    ALBUMY_SEARCH_CACHE_TTL = 60  # 搜索结果的缓存时间（秒）
+    ALBUMY_SEARCH_MAX_RESULTS = 1000  # 每个搜索词最多返回的结果数量
+    ALBUMY_TYPEAHEAD_LIMIT = 8  # 输入提示中每类（用户、标签）最多显示的数量
+    ALBUMY_TYPEAHEAD_TTL = 300  # 输入提示重新加载用户名和标签名的间隔（秒），用于同步其他进程的修改
     ALBUMY_PHOTO_SIZE = {'small': 400,
                          'medium': 800}
     ALBUMY_PHOTO_SUFFIX = {
         ALBUMY_PHOTO_SIZE['small']: '_s',  # thumbnail
         ALBUMY_PHOTO_SIZE['medium']: '_m'  # display
     }
+    # 缩略图额外生成的图片格式{MIME类型: 扩展名}，按Accept首部返回体积最小的版本；AVIF需要安装pillow-avif-plugin
+    ALBUMY_PHOTO_VARIANTS = {'image/avif': '.avif', 'image/webp': '.webp'}
+    ALBUMY_UPLOAD_MAX_AGE = 365 * 24 * 3600  # 图片和头像的浏览器缓存时间（秒）
+    ALBUMY_VARIANT_SIZE_TTL = 3600  # 图片各格式版本文件大小的缓存时间（秒），用于选择体积最小的版本
+    # Nginx中映射到ALBUMY_UPLOAD_PATH的internal location（如/_uploads/），设置后由Nginx发送图片文件；
+    # 使用Apache或lighttpd时可以改为设置USE_X_SENDFILE = True
+    ALBUMY_ACCEL_REDIRECT_PREFIX = os.getenv('ALBUMY_ACCEL_REDIRECT_PREFIX')
+    # 图片和头像的存储后端：local为本地磁盘；s3为S3协议的对象存储，此时上传目录作为本地缓存
+    ALBUMY_STORAGE = os.getenv('ALBUMY_STORAGE', 'local')
+    ALBUMY_S3_BUCKET = os.getenv('ALBUMY_S3_BUCKET')
+    ALBUMY_S3_ENDPOINT_URL = os.getenv('ALBUMY_S3_ENDPOINT_URL')  # MinIO等S3兼容服务的地址，为空时使用AWS S3
+    ALBUMY_S3_PRESIGN = True  # 是否把图片请求重定向到预签名URL，为False时从本地缓存发送
+    ALBUMY_S3_URL_EXPIRES = 3600  # 预签名URL的有效期（秒）
+
+    # 缓存后端：simple为进程内缓存，多进程部署时各进程的计数可能有ALBUMY_NOTIFICATION_COUNT_TTL秒的延迟；
+    # redis为REDIS_URL指定的Redis，需要安装redis
+    ALBUMY_CACHE_TYPE = os.getenv('ALBUMY_CACHE_TYPE', 'simple')
+    REDIS_URL = os.getenv('REDIS_URL', 'redis://localhost')
+    ALBUMY_NOTIFICATION_COUNT_TTL = 300  # 未读消息数量的缓存时间（秒）
+    ALBUMY_IDENTITY_CACHE_SIZE = 10000  # 进程内缓存的登录用户数量
+    ALBUMY_IDENTITY_CACHE_TTL = 30  # ALBUMY_CACHE_TYPE为simple时，进程内用户身份的缓存时间（秒）
+    ALBUMY_IDENTITY_SHARED_TTL = 600  # ALBUMY_CACHE_TYPE为redis时，用户身份在Redis中的缓存时间（秒）
+    # 消息推送的发布订阅后端：local为进程内，只适用于单进程部署；redis为REDIS_URL指定的Redis
+    ALBUMY_PUBSUB_TYPE = os.getenv('ALBUMY_PUBSUB_TYPE', 'local')
+    ALBUMY_SSE_HEARTBEAT = 15  # 消息推送连接的心跳间隔（秒），防止代理服务器断开空闲连接
+    ALBUMY_SSE_TIMEOUT = 300  # 消息推送连接的最长时间（秒），超过后断开，由浏览器自动重新连接
+    ALBUMY_NOTIFICATION_RETENTION_DAYS = 180  # 已读消息的保留天数，过期后由flask prune-notifications删除
+    ALBUMY_NOTIFICATION_PRUNE_BATCH = 1000  # 每批删除的消息数量
+    ALBUMY_NOTIFICATION_INTERVAL = 5  # 后台写入消息的间隔（秒）
+    ALBUMY_NOTIFICATION_BATCH = 500  # 每批写入的消息事件数量
+    ALBUMY_NOTIFICATION_LEASE = 300  # 接收者的消息事件被领取后的处理时限（秒），超时未完成时由其他线程重新处理
+    ALBUMY_NOTIFICATION_COALESCE_WINDOW = 3600  # 该时间（秒）内相同的未读消息合并为一条
 
     SECRET_KEY = os.getenv('SECRET_KEY', 'secret string')
-    MAX_CONTENT_LENGTH = 3 * 1024 * 1204  # file size exceed to 3MB will return 413 error response
+    # file size exceed to 3MB will return 413 error response，图片使用分块上传，这里只限制单个分块的大小
+    MAX_CONTENT_LENGTH = 3 * 1024 * 1204
 
     BOOTSTRAP_SERVER_LOCAL = True
 
@@ -50,28 +119,32 @@ class BaseConfig(object):
 
     MAIL_SERVER = os.getenv('MAIL_SERVER')
     MAIL_PORT = os.getenv('MAIL_PORT')
-    MAIL_USE_SSL = True
+    # 使用本地调试SMTP服务器（如python -m aiosmtpd -n -l localhost:8025）时设置为false
+    MAIL_USE_SSL = os.getenv('MAIL_USE_SSL', 'true').lower() == 'true'
     MAIL_USERNAME = os.getenv('MAIL_USERNAME')
     MAIL_PASSWORD = os.getenv('MAIL_PASSWORD')
     MAIL_DEFAULT_SENDER = ('Albumy Admin', MAIL_USERNAME)
 
     DROPZONE_ALLOWED_FILE_TYPE = 'image'
-    DROPZONE_MAX_FILE_SIZE = 3  # 3MB
+    DROPZONE_MAX_FILE_SIZE = ALBUMY_MAX_UPLOAD_SIZE // (1024 * 1024)  # 50MB
     DROPZONE_MAX_FILES = 30  # 单次最大上传数量
     DROPZONE_ENABLE_CSRF = True  # 开启CSRFProtector
 
-    WHOOSHEE_MIN_STRING_LEN = 1  # whooshee搜索关键字的最小长度
-
 
 class DevelopmentConfig(BaseConfig):
     SQLALCHEMY_DATABASE_URI = prefix + os.path.join(basedir, 'data-dev.db')
-    REDIS_URL = os.getenv('REDIS_URL', 'redis://localhost')
 
 
 class TestingConfig(BaseConfig):
     TESTING = True
     WTF_CSRF_ENABLED = False
-    SQLALCHEMY_DATABASE_URI = 'sqlite:///memory:'
+    ALBUMY_TASK_ASYNC = False
+    # 测试数据库、生成的头像和上传的文件保存在临时目录中。不使用内存数据库：
+    # 内存数据库只有一个连接，后台任务和guard_files()使用的独立会话会共用请求会话的事务
+    SQLALCHEMY_DATABASE_URI = prefix + os.path.join(tempfile.gettempdir(), 'albumy-test', 'data.db')
+    ALBUMY_UPLOAD_PATH = os.path.join(tempfile.gettempdir(), 'albumy-test', 'uploads')
+    ALBUMY_CHUNK_PATH = os.path.join(tempfile.gettempdir(), 'albumy-test', 'uploads-partial')
+    AVATARS_SAVE_PATH = os.path.join(ALBUMY_UPLOAD_PATH, 'avatars')
 
 
 class ProductionConfig(BaseConfig):
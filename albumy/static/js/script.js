@@ -113,22 +113,82 @@ $(function () {
     }
 
 
-    function update_notifications_count() {
+    function show_notifications_count(count) {
         var $el = $('#notification-badge');
+        if (count === 0) {
+            $el.hide();
+        } else {
+            $el.show();
+            $el.text(count)
+        }
+    }
+
+    function update_notifications_count() {
         $.ajax({
             type: 'GET',
-            url: $el.data('href'),
+            url: $('#notification-badge').data('href'),
             success: function (data) {
-                if (data.count === 0) {
-                    $('#notification-badge').hide();
-                } else {
-                    $el.show();
-                    $el.text(data.count)
-                }
+                show_notifications_count(data.count);
             }
         });
     }
 
+    var notifications_poller = null;
+
+    function poll_notifications_count() {
+        if (notifications_poller === null) {
+            notifications_poller = setInterval(update_notifications_count, 30000);
+        }
+    }
+
+    // 通过Server-Sent Events接收服务器推送的未读消息数量；浏览器不支持或连接失败时改为轮询
+    function listen_notifications() {
+        if (!window.EventSource) {
+            poll_notifications_count();
+            return;
+        }
+        var source = new EventSource($('#notification-badge').data('stream'));
+        source.addEventListener('count', function (e) {
+            show_notifications_count(JSON.parse(e.data).count);
+        });
+        source.addEventListener('notification', function (e) {
+            toast('You have a new notification.');
+        });
+        source.onerror = function () {
+            // 连接意外断开时浏览器会自动重连，只有连接被关闭（如服务器返回错误）时才改为轮询
+            if (source.readyState === EventSource.CLOSED) {
+                poll_notifications_count();
+            }
+        };
+    }
+
+    var typeahead_timer = null;
+
+    function update_search_suggestions() {
+        var $el = $('#search-input');
+        clearTimeout(typeahead_timer);
+        typeahead_timer = setTimeout(function () {
+            var q = $el.val().trim();
+            if (!q) {
+                return;
+            }
+            $.ajax({
+                type: 'GET',
+                url: $el.data('href'),
+                data: {q: q},
+                success: function (data) {
+                    var $list = $('#search-suggestions').empty();
+                    $.each(data.users, function (i, user) {
+                        $list.append($('<option>').attr('value', user.username).text('User'));
+                    });
+                    $.each(data.tags, function (i, tag) {
+                        $list.append($('<option>').attr('value', tag.name).text('Tag'));
+                    });
+                }
+            });
+        }, 150);
+    }
+
     function follow(e) {
         var $el = $(e.target);
         var id = $el.data('id');
@@ -193,6 +253,7 @@ $(function () {
     }
 
     $('.profile-popover').hover(show_profile_popover.bind(this), hide_profile_popover.bind(this));
+    $('#search-input').on('input', update_search_suggestions);
     $(document).on('click', '.follow-btn', follow.bind(this));
     $(document).on('click', '.unfollow-btn', unfollow.bind(this));
     $(document).on('click', '.collect-btn', collect.bind(this));
@@ -221,9 +282,8 @@ $(function () {
     $('#confirm-delete').on('show.bs.modal', function (e) {
         $('.delete-form').attr('action', $(e.relatedTarget).data('href'));
     });
-    //轮询：每间隔30秒调用更新消息数量方法获取未读消息数
     if (is_authenticated) {
-        setInterval(update_notifications_count, 30000);
+        listen_notifications();
     }
 
     $("[data-toggle='tooltip']").tooltip({title: moment($(this).data('timestamp')).format('lll')})
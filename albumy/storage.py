@@ -0,0 +1,174 @@
+import mimetypes
+import os
+import shutil
+import tempfile
+
+from flask import current_app
+from werkzeug.utils import safe_join
+
+from albumy import paths
+
+try:
+    import boto3
+    from boto3.s3.transfer import TransferConfig
+    from botocore.exceptions import ClientError
+except ImportError:  # 只有使用S3存储时才需要安装boto3
+    boto3 = None
+
+
+class LocalStorage(object):
+    """本地磁盘存储，文件按paths的分片规则保存在root目录下"""
+
+    def __init__(self, root):
+        self.root = root
+
+    def path(self, name):
+        """返回文件在本地磁盘上的路径，文件不存在时抛出FileNotFoundError"""
+        path = safe_join(self.root, paths.resolve(self.root, name))
+        if path is None or not os.path.isfile(path):
+            raise FileNotFoundError(name)
+        return path
+
+    def staging_path(self, name):
+        """返回新文件在本地应写入的路径，写入后调用save_file(name, path)保存"""
+        return paths.prepare(self.root, name)
+
+    def save_file(self, name, source):
+        """把本地文件source保存为name，source会被移动"""
+        target = paths.prepare(self.root, name)
+        if os.path.abspath(source) != target:
+            shutil.move(source, target)
+
+    def size(self, name):
+        """返回文件大小，文件不存在时返回None"""
+        try:
+            return os.path.getsize(self.path(name))
+        except OSError:
+            return None
+
+    def delete(self, name):
+        path = safe_join(self.root, paths.resolve(self.root, name))
+        if path is not None and os.path.exists(path):
+            os.remove(path)
+
+    def url(self, name):
+        """本地文件由应用自己发送，没有外部URL"""
+        return None
+
+
+class S3Storage(object):
+    """S3协议的对象存储（AWS S3、MinIO等），对象键为prefix加上分片后的文件名。
+    cache_dir作为本地读缓存：读取（如生成缩略图）时先把对象下载到本地，之后直接读取本地文件；
+    新文件也先写入cache_dir，再以分片（multipart）方式上传"""
+
+    def __init__(self, bucket, prefix, cache_dir, endpoint_url=None, presign=True, expires=3600, max_age=None):
+        if boto3 is None:
+            raise RuntimeError('S3 storage requires boto3, install it with "pip install boto3".')
+        self.bucket = bucket
+        self.prefix = prefix
+        self.cache_dir = cache_dir
+        self.presign = presign
+        self.expires = expires
+        self.max_age = max_age
+        self.client = boto3.client('s3', endpoint_url=endpoint_url)
+        self.transfer_config = TransferConfig(multipart_threshold=8 * 1024 * 1024,
+                                              multipart_chunksize=8 * 1024 * 1024)
+
+    def key(self, name):
+        return self.prefix + paths.shard(name)
+
+    def _cache_path(self, name):
+        path = safe_join(self.cache_dir, paths.shard(name))
+        if path is None:
+            raise FileNotFoundError(name)
+        return path
+
+    def path(self, name):
+        """返回文件在本地缓存中的路径，缓存中没有时先从对象存储下载"""
+        path = self._cache_path(name)
+        if not os.path.isfile(path):
+            fd, temp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.part')
+            os.close(fd)
+            try:
+                self.client.download_file(self.bucket, self.key(name), temp_path)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                os.replace(temp_path, path)
+            except ClientError as e:
+                if e.response['Error']['Code'] in ('404', 'NoSuchKey'):
+                    raise FileNotFoundError(name)
+                raise
+            finally:
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+        return path
+
+    def staging_path(self, name):
+        path = self._cache_path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return path
+
+    def save_file(self, name, source):
+        """上传本地文件source，超过8MB时自动分片上传；上传后文件保留在本地缓存中"""
+        extra_args = {'ContentType': mimetypes.guess_type(name)[0] or 'application/octet-stream'}
+        if self.max_age is not None:  # 文件名唯一，内容不会改变
+            extra_args['CacheControl'] = 'public, max-age=%d, immutable' % self.max_age
+        self.client.upload_file(source, self.bucket, self.key(name), ExtraArgs=extra_args,
+                                Config=self.transfer_config)
+        target = self.staging_path(name)
+        if os.path.abspath(source) != target:
+            shutil.move(source, target)
+
+    def size(self, name):
+        try:
+            return os.path.getsize(self._cache_path(name))
+        except OSError:
+            pass
+        try:
+            return self.client.head_object(Bucket=self.bucket, Key=self.key(name))['ContentLength']
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey'):
+                return None
+            raise
+
+    def delete(self, name):
+        self.client.delete_object(Bucket=self.bucket, Key=self.key(name))
+        path = safe_join(self.cache_dir, paths.shard(name))
+        if path is not None and os.path.exists(path):
+            os.remove(path)
+
+    def url(self, name):
+        """返回文件的预签名URL，浏览器直接从对象存储下载；关闭预签名时返回None，由应用从本地缓存发送"""
+        if not self.presign:
+            return None
+        return self.client.generate_presigned_url('get_object', Params={'Bucket': self.bucket, 'Key': self.key(name)},
+                                                  ExpiresIn=self.expires)
+
+
+class Storage(object):
+    """根据ALBUMY_STORAGE配置为图片和头像创建存储后端，通过storage.photos和storage.avatars访问。
+    使用S3存储时，ALBUMY_UPLOAD_PATH和AVATARS_SAVE_PATH作为本地缓存目录"""
+
+    def init_app(self, app):
+        if app.config['ALBUMY_STORAGE'] == 's3':
+            options = dict(bucket=app.config['ALBUMY_S3_BUCKET'],
+                           endpoint_url=app.config['ALBUMY_S3_ENDPOINT_URL'],
+                           presign=app.config['ALBUMY_S3_PRESIGN'],
+                           expires=app.config['ALBUMY_S3_URL_EXPIRES'],
+                           max_age=app.config['ALBUMY_UPLOAD_MAX_AGE'])
+            backends = {'photos': S3Storage(prefix='photos/', cache_dir=app.config['ALBUMY_UPLOAD_PATH'], **options),
+                        'avatars': S3Storage(prefix='avatars/', cache_dir=app.config['AVATARS_SAVE_PATH'], **options)}
+        else:
+            backends = {'photos': LocalStorage(app.config['ALBUMY_UPLOAD_PATH']),
+                        'avatars': LocalStorage(app.config['AVATARS_SAVE_PATH'])}
+        app.extensions['albumy_storage'] = backends
+
+    @property
+    def photos(self):
+        return current_app.extensions['albumy_storage']['photos']
+
+    @property
+    def avatars(self):
+        return current_app.extensions['albumy_storage']['avatars']
+
+
+storage = Storage()
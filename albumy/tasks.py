@@ -0,0 +1,113 @@
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from flask import current_app
+
+
+class ProcessQueue(object):
+    """基于进程池的后台任务队列，用于图片处理等CPU密集型任务，不受GIL限制。
+
+    任务函数在子进程中执行，不能使用应用上下文，参数和返回值都需要能被pickle；
+    回调函数在当前进程中、推送了应用上下文后执行，可以访问数据库。
+    ALBUMY_TASK_ASYNC为False时（如测试环境），任务和回调都在调用处同步执行"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._executor = None
+
+    def _get_executor(self):
+        # 进程池在第一次提交任务时才创建，确保在Web服务器fork出工作进程之后创建
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ProcessPoolExecutor(
+                        max_workers=current_app.config['ALBUMY_TASK_WORKERS'],
+                        mp_context=multiprocessing.get_context('spawn'))
+        return self._executor
+
+    def submit(self, func, *args, callback=None, errback=None):
+        """提交任务，任务成功时调用callback(result)，失败时调用errback(exception)"""
+        app = current_app._get_current_object()
+        if not app.config['ALBUMY_TASK_ASYNC']:
+            try:
+                result = func(*args)
+            except Exception as e:
+                if errback is None:
+                    raise
+                errback(e)
+            else:
+                if callback is not None:
+                    callback(result)
+            return
+
+        def done(future):
+            with app.app_context():
+                error = future.exception()
+                if error is not None:
+                    if errback is not None:
+                        errback(error)
+                    else:
+                        app.logger.error('Background task %s failed: %r', func.__name__, error)
+                elif callback is not None:
+                    callback(future.result())
+
+        self._get_executor().submit(func, *args).add_done_callback(done)
+
+
+process_queue = ProcessQueue()
+
+
+class BackgroundWorker(object):
+    """后台线程任务：被wake()唤醒或每隔一段时间（秒数由配置项interval_key指定）在应用上下文中执行func，
+    用于批量处理保存在数据库中的队列。func返回True表示还有待处理的数据，会立即再次执行。
+    指定workers_key时启动该配置项指定数量的线程同时执行func，func需要自行保证多个线程不会处理同一条数据。
+    ALBUMY_TASK_ASYNC为False时在调用wake()或start()处同步执行"""
+
+    def __init__(self, func, interval_key, workers_key=None):
+        self.func = func
+        self.interval_key = interval_key
+        self.workers_key = workers_key
+        self._lock = threading.Lock()
+        self._event = threading.Event()
+        self._threads = []
+        self._pid = None
+
+    def wake(self):
+        """立即执行一次"""
+        if self.start():
+            self._event.set()
+
+    def start(self):
+        """确保后台线程已经启动，之后按间隔执行；新启动的线程会先执行一次。
+        返回False表示已经同步执行完毕"""
+        app = current_app._get_current_object()
+        if not app.config['ALBUMY_TASK_ASYNC']:
+            while self.func():
+                pass
+            return False
+        # 线程在第一次唤醒时才启动；fork出的子进程中没有父进程的线程，需要重新启动
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._event = threading.Event()
+                    self._event.set()
+                    workers = app.config[self.workers_key] if self.workers_key else 1
+                    self._threads = [threading.Thread(target=self._run, args=(app, self._event),
+                                                      name=self.func.__name__, daemon=True) for _ in range(workers)]
+                    for thread in self._threads:
+                        thread.start()
+                    self._pid = os.getpid()
+        return True
+
+    def _run(self, app, event):
+        while True:
+            event.wait(app.config[self.interval_key])
+            event.clear()
+            with app.app_context():
+                try:
+                    while self.func():
+                        pass
+                except Exception:
+                    app.logger.exception('Background task %s failed', self.func.__name__)
@@ -0,0 +1,62 @@
+import os
+
+from flask import current_app
+
+from albumy import paths
+from albumy.extensions import db
+from albumy.models import Photo
+from albumy.storage import storage
+from albumy.tasks import process_queue
+from albumy.utils import resize_images, store_variant_sizes
+
+
+def generate_thumbnails(photo):
+    """把图片的缩略图生成任务提交到后台进程池，需要在photo提交到数据库后调用。
+    生成完成前filename_s和filename_m指向原图，模板中直接显示原图"""
+    photo_id, blob_id, filename = photo.id, photo.blob_id, photo.filename
+    # 缩略图生成在原图的本地路径（使用对象存储时为本地缓存）所在的目录中
+    process_queue.submit(resize_images, storage.photos.path(filename), filename,
+                         current_app.config['ALBUMY_PHOTO_SUFFIX'],
+                         tuple(current_app.config['ALBUMY_PHOTO_VARIANTS'].values()),
+                         callback=lambda filenames: thumbnails_ready(photo_id, blob_id, filename, filenames),
+                         errback=lambda error: thumbnails_failed(photo_id, blob_id, error))
+
+
+def same_file_photos(photo_id, blob_id):
+    """返回与图片使用同一文件的所有图片的查询，它们共用缩略图"""
+    if blob_id is None:
+        return Photo.query.filter_by(id=photo_id)
+    return Photo.query.filter_by(blob_id=blob_id)
+
+
+def thumbnails_ready(photo_id, blob_id, filename, filenames):
+    """缩略图生成完成后把缩略图及其各格式版本保存到存储中，并更新图片记录"""
+    renditions = paths.with_variants(filenames.values()) - {filename}
+    file_sizes = {}  # 文件名 -> 文件大小，没有生成的文件为None
+    for name in renditions:
+        path = storage.photos.staging_path(name)
+        if os.path.exists(path):  # Pillow不支持的格式不会生成文件
+            file_sizes[name] = os.path.getsize(path)
+            storage.photos.save_file(name, path)
+        else:
+            file_sizes[name] = None
+    sizes = current_app.config['ALBUMY_PHOTO_SIZE']
+    updated = same_file_photos(photo_id, blob_id).update({
+        'filename_s': filenames[sizes['small']],
+        'filename_m': filenames[sizes['medium']],
+        'rendition_status': 'ready'
+    }, synchronize_session=False)
+    db.session.commit()
+    if not updated:  # 生成期间图片已被删除，清理生成的文件
+        for name in renditions:
+            storage.photos.delete(name)
+        return
+    for name in set(filenames.values()):  # 覆盖生成前缓存的结果，原图的格式版本也在这时才生成
+        store_variant_sizes(storage.photos, name, file_sizes)
+
+
+def thumbnails_failed(photo_id, blob_id, error):
+    """缩略图生成失败时记录日志并标记状态，图片继续使用原图显示"""
+    current_app.logger.error('Failed to render thumbnails for photo %s: %r', photo_id, error)
+    same_file_photos(photo_id, blob_id).update({'rendition_status': 'failed'}, synchronize_session=False)
+    db.session.commit()
@@ -0,0 +1,86 @@
+import heapq
+
+from flask import current_app
+from sqlalchemy.orm import joinedload
+
+from albumy.extensions import db
+from albumy.models import Timeline, Photo, Follow, User
+from albumy.pagination import KeysetPagination, encode_cursor, decode_cursor, after_cursor
+
+
+def is_celebrity(user):
+    """关注者过多的用户不做写扩散，他们的图片在读取时间线时实时查询"""
+    return user.followers_count > current_app.config['ALBUMY_TIMELINE_FANOUT_LIMIT']
+
+
+def fan_out_photo(photo):
+    """把新上传的图片写入作者所有关注者的时间线，需要在photo写入数据库（flush）后调用。
+    是否写扩散记录在photo.fanned_out中，作者的关注者数量之后跨过阈值时，已上传的图片不会从时间线中消失"""
+    if is_celebrity(photo.author):
+        return
+    photo.fanned_out = True
+    select = db.select([Follow.follower_id, Photo.id, Photo.timestamp]) \
+        .where(Follow.followed_id == Photo.author_id) \
+        .where(Photo.id == photo.id)
+    db.session.execute(Timeline.__table__.insert().from_select(['user_id', 'photo_id', 'timestamp'], select))
+
+
+def backfill_timeline(follower, followed):
+    """关注用户时，把被关注者最近的已写扩散的图片回填到关注者的时间线中，其他图片在读取时实时查询"""
+    existing = db.select([Timeline.photo_id]).where(Timeline.user_id == follower.id)
+    select = db.select([db.literal(follower.id), Photo.id, Photo.timestamp]) \
+        .where(Photo.author_id == followed.id, Photo.fanned_out) \
+        .where(Photo.id.notin_(existing)) \
+        .order_by(Photo.timestamp.desc()) \
+        .limit(current_app.config['ALBUMY_TIMELINE_BACKFILL'])
+    db.session.execute(Timeline.__table__.insert().from_select(['user_id', 'photo_id', 'timestamp'], select))
+
+
+def prune_timeline(follower, followed):
+    """取消关注时，从关注者的时间线中移除被关注者的图片"""
+    photo_ids = db.session.query(Photo.id).filter(Photo.author_id == followed.id)
+    Timeline.query.filter(Timeline.user_id == follower.id, Timeline.photo_id.in_(photo_ids)) \
+        .delete(synchronize_session=False)
+
+
+def rebuild_timeline():
+    """根据关注关系重建所有用户的时间线，按作者现在的关注者数量重新决定每张图片是否写扩散"""
+    Timeline.query.delete(synchronize_session=False)
+    authors = db.select([User.id]).where(User.followers_count <= current_app.config['ALBUMY_TIMELINE_FANOUT_LIMIT'])
+    Photo.query.update({Photo.fanned_out: Photo.author_id.in_(authors)}, synchronize_session=False)
+    select = db.select([Follow.follower_id, Photo.id, Photo.timestamp]) \
+        .select_from(db.join(Follow, Photo, Follow.followed_id == Photo.author_id)) \
+        .where(Photo.fanned_out)
+    db.session.execute(Timeline.__table__.insert().from_select(['user_id', 'photo_id', 'timestamp'], select))
+    db.session.commit()
+
+
+def read_timeline(user, cursor=None, per_page=12):
+    """按游标读取用户的首页时间线，返回KeysetPagination。
+    已写扩散的图片来自物化的时间线表，关注的用户未写扩散的图片（上传时作者的关注者过多）实时查询，两者按时间归并"""
+    values = decode_cursor(cursor, [Timeline.timestamp, Timeline.photo_id]) if cursor else None
+    fanned = db.session.query(Timeline.timestamp, Timeline.photo_id).filter(Timeline.user_id == user.id)
+    celebrities = db.session.query(Photo.timestamp, Photo.id) \
+        .join(Follow, Follow.followed_id == Photo.author_id) \
+        .filter(Follow.follower_id == user.id, db.not_(Photo.fanned_out))
+    if values is not None:
+        fanned = fanned.filter(after_cursor([Timeline.timestamp, Timeline.photo_id], values))
+        celebrities = celebrities.filter(after_cursor([Photo.timestamp, Photo.id], values))
+    # 每个来源最多取per_page + 1条，多出的一条用于判断是否还有下一页
+    fanned = fanned.order_by(Timeline.timestamp.desc(), Timeline.photo_id.desc()).limit(per_page + 1).all()
+    celebrities = celebrities.order_by(Photo.timestamp.desc(), Photo.id.desc()).limit(per_page + 1).all()
+
+    entries = []
+    seen = set()
+    for timestamp, photo_id in heapq.merge(fanned, celebrities, reverse=True):
+        if photo_id not in seen:
+            seen.add(photo_id)
+            entries.append((timestamp, photo_id))
+    next_cursor = encode_cursor(entries[per_page - 1]) if len(entries) > per_page else None
+    entries = entries[:per_page]
+
+    photos = Photo.query.options(joinedload(Photo.author)) \
+        .filter(Photo.id.in_([photo_id for _, photo_id in entries])).all()
+    photos.sort(key=lambda photo: (photo.timestamp, photo.id), reverse=True)
+    return KeysetPagination(photos, per_page, cursor=cursor if values is not None else None,
+                            next_cursor=next_cursor)
@@ -0,0 +1,150 @@
+import threading
+import time
+from collections import namedtuple
+
+from flask import current_app
+from sqlalchemy.orm import Session, object_session
+
+from albumy.extensions import db
+from albumy.models import User, Tag
+
+Suggestion = namedtuple('Suggestion', ['kind', 'id', 'name'])
+
+
+class _Node(object):
+    __slots__ = ('children', 'entries')
+
+    def __init__(self):
+        self.children = {}
+        self.entries = {}  # id -> 名称，以该节点结尾的词（不区分大小写）
+
+
+class PrefixTrie(object):
+    """前缀树，按小写后的名称保存(id, 名称)，按前缀查找时只需遍历前缀对应的子树"""
+
+    def __init__(self):
+        self._root = _Node()
+
+    def add(self, id, name):
+        node = self._root
+        for char in name.lower():
+            node = node.children.setdefault(char, _Node())
+        node.entries[id] = name
+
+    def remove(self, id, name):
+        path, node = [], self._root
+        for char in name.lower():
+            if char not in node.children:
+                return
+            path.append((node, char))
+            node = node.children[char]
+        node.entries.pop(id, None)
+        # 删除不再包含任何词的节点
+        for parent, char in reversed(path):
+            child = parent.children[char]
+            if child.entries or child.children:
+                break
+            del parent.children[char]
+
+    def find(self, prefix, limit):
+        """返回以prefix开头的词的(id, 名称)列表，按字母顺序，最多limit个"""
+        node = self._root
+        for char in prefix.lower():
+            node = node.children.get(char)
+            if node is None:
+                return []
+        results, stack = [], [node]
+        while stack and len(results) < limit:
+            node = stack.pop()
+            results.extend(sorted(node.entries.items(), key=lambda item: item[1]))
+            stack.extend(node.children[char] for char in sorted(node.children, reverse=True))
+        return results[:limit]
+
+
+class Typeahead(object):
+    """用户名和标签名的输入提示：在内存中维护所有用户名和标签名的前缀树。
+    本进程中的新增、修改和删除在事务提交后增量更新到前缀树中；其他进程的修改不会同步，
+    前缀树每隔ALBUMY_TYPEAHEAD_TTL秒重新加载"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._tries = None  # 类别（user、tag） -> PrefixTrie
+        self._expires_at = 0
+
+    def _load(self):
+        tries = {'user': PrefixTrie(), 'tag': PrefixTrie()}
+        for id, username in db.session.query(User.id, User.username):
+            tries['user'].add(id, username)
+        for id, name in db.session.query(Tag.id, Tag.name):
+            tries['tag'].add(id, name)
+        self._tries = tries
+        self._expires_at = time.monotonic() + current_app.config['ALBUMY_TYPEAHEAD_TTL']
+
+    def suggest(self, prefix, kind):
+        """返回以prefix开头的用户名（kind为user）或标签名（kind为tag）的(id, 名称)列表"""
+        if self._tries is None or time.monotonic() >= self._expires_at:
+            with self._lock:
+                if self._tries is None or time.monotonic() >= self._expires_at:
+                    self._load()
+        with self._lock:
+            return self._tries[kind].find(prefix, current_app.config['ALBUMY_TYPEAHEAD_LIMIT'])
+
+    def apply(self, changes):
+        """应用已提交的修改，changes为(操作, Suggestion)列表，操作为add或remove"""
+        with self._lock:
+            if self._tries is None:
+                return
+            for operation, suggestion in changes:
+                trie = self._tries[suggestion.kind]
+                if operation == 'add':
+                    trie.add(suggestion.id, suggestion.name)
+                else:
+                    trie.remove(suggestion.id, suggestion.name)
+
+
+typeahead = Typeahead()
+
+# 需要加入输入提示的模型：模型 -> (类别, 名称属性)
+_TYPEAHEAD_MODELS = {User: ('user', 'username'), Tag: ('tag', 'name')}
+
+
+def _record_change(session, operation, suggestion):
+    session.info.setdefault('typeahead', []).append((operation, suggestion))
+
+
+def _after_insert(mapper, connection, target):
+    kind, attr = _TYPEAHEAD_MODELS[mapper.class_]
+    _record_change(object_session(target), 'add', Suggestion(kind, target.id, getattr(target, attr)))
+
+
+def _after_update(mapper, connection, target):
+    kind, attr = _TYPEAHEAD_MODELS[mapper.class_]
+    history = db.inspect(target).attrs[attr].history
+    if history.has_changes():
+        session = object_session(target)
+        for name in history.deleted:
+            _record_change(session, 'remove', Suggestion(kind, target.id, name))
+        _record_change(session, 'add', Suggestion(kind, target.id, getattr(target, attr)))
+
+
+def _after_delete(mapper, connection, target):
+    kind, attr = _TYPEAHEAD_MODELS[mapper.class_]
+    _record_change(object_session(target), 'remove', Suggestion(kind, target.id, getattr(target, attr)))
+
+
+for _model in _TYPEAHEAD_MODELS:
+    db.event.listen(_model, 'after_insert', _after_insert)
+    db.event.listen(_model, 'after_update', _after_update)
+    db.event.listen(_model, 'after_delete', _after_delete)
+
+
+@db.event.listens_for(Session, 'after_commit')
+def update_typeahead(session):
+    changes = session.info.pop('typeahead', None)
+    if changes:
+        typeahead.apply(changes)
+
+
+@db.event.listens_for(Session, 'after_rollback')
+def discard_typeahead_changes(session):
+    session.info.pop('typeahead', None)
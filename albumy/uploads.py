@@ -0,0 +1,113 @@
+import json
+import os
+import re
+import time
+
+from flask import current_app, abort
+
+# Dropzone为每个文件生成的上传id，只允许用作文件名的安全字符
+_upload_id = re.compile(r'^[A-Za-z0-9_-]{1,64}$')
+
+
+def _partial_path(user_id, upload_id):
+    """返回分块上传的临时文件路径（不含扩展名），上传id按用户隔离，不同用户的相同id互不影响"""
+    if not _upload_id.match(upload_id):
+        abort(400)
+    return os.path.join(current_app.config['ALBUMY_CHUNK_PATH'], '%s-%s' % (user_id, upload_id))
+
+
+def _int_field(form, name, minimum=0):
+    try:
+        value = int(form[name])
+    except (KeyError, ValueError):
+        abort(400)
+    if value < minimum:
+        abort(400)
+    return value
+
+
+def _load_received(partial):
+    try:
+        with open(partial + '.json') as f:
+            return set(json.load(f))
+    except (OSError, ValueError):
+        return set()
+
+
+def _save_received(partial, received):
+    temp_path = '%s.json.%d' % (partial, os.getpid())
+    with open(temp_path, 'w') as f:
+        json.dump(sorted(received), f)
+    os.replace(temp_path, partial + '.json')
+
+
+def receive_chunk(user_id, f, form):
+    """把Dropzone分块上传的一个分块写入临时文件中对应的偏移位置，内存占用只与读取缓冲区大小有关。
+    已经收到的分块（断线后重新上传时）不再写入；所有分块都收到后返回合并后的文件路径，否则返回None"""
+    partial = _partial_path(user_id, form.get('dzuuid', ''))
+    index = _int_field(form, 'dzchunkindex')
+    count = _int_field(form, 'dztotalchunkcount', 1)
+    total = _int_field(form, 'dztotalfilesize', 1)
+    offset = _int_field(form, 'dzchunkbyteoffset')
+    if total > current_app.config['ALBUMY_MAX_UPLOAD_SIZE']:
+        abort(413)
+    if index >= count or offset >= total:
+        abort(400)
+
+    os.makedirs(current_app.config['ALBUMY_CHUNK_PATH'], exist_ok=True)
+    received = _load_received(partial)
+    if index not in received:
+        fd = os.open(partial + '.part', os.O_RDWR | os.O_CREAT, 0o644)
+        with os.fdopen(fd, 'r+b') as output:
+            output.seek(offset)
+            written = 0
+            for block in iter(lambda: f.stream.read(64 * 1024), b''):
+                written += len(block)
+                if offset + written > total:  # 分块超出了声明的文件大小
+                    abort(400)
+                output.write(block)
+        received = _load_received(partial) | {index}  # 重新读取，合并同时完成的其他分块
+        _save_received(partial, received)
+
+    if len(received) < count:
+        return None
+    # 把合并好的文件移走，同时完成的重试请求会因为文件已不存在而返回None
+    assembled = '%s.%d.done' % (partial, os.getpid())
+    try:
+        os.replace(partial + '.part', assembled)
+    except FileNotFoundError:
+        return None
+    if os.path.exists(partial + '.json'):
+        os.remove(partial + '.json')
+    if os.path.getsize(assembled) != total:
+        os.remove(assembled)
+        abort(400)
+    return assembled
+
+
+def upload_status(user_id, upload_id):
+    """返回分块上传的进度：已经收到的分块序号和临时文件大小，用于客户端判断从哪里继续上传"""
+    partial = _partial_path(user_id, upload_id)
+    try:
+        size = os.path.getsize(partial + '.part')
+    except OSError:
+        size = 0
+    return {'chunks': sorted(_load_received(partial)), 'size': size}
+
+
+def clean_partials(max_age):
+    """删除超过max_age秒未更新的分块上传临时文件，返回删除的文件数量"""
+    directory = current_app.config['ALBUMY_CHUNK_PATH']
+    if not os.path.isdir(directory):
+        return 0
+    deadline = time.time() - max_age
+    removed = 0
+    for filename in os.listdir(directory):
+        path = os.path.join(directory, filename)
+        try:
+            if os.path.getmtime(path) < deadline:
+                os.remove(path)
+                removed += 1
+        except FileNotFoundError:  # 上传已经完成
+            continue
+    return removed
@@ -1,14 +1,28 @@
+import hashlib
+import mimetypes
 import os
-import uuid
+import tempfile
+from datetime import datetime, timezone
 from PIL import Image
 
-from urllib.parse import urljoin, urlparse
-from flask import request, redirect, url_for, flash, current_app
+from urllib.parse import urljoin, urlparse, quote
+from flask import request, redirect, url_for, flash, current_app, abort, send_file
 from authlib.jose import jwt, JoseError
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from werkzeug.http import is_resource_modified
 
+try:
+    import pillow_avif  # noqa: F401 为Pillow注册AVIF格式，未安装时不生成AVIF版本
+except ImportError:
+    pass
+
+from albumy.cache import cache
 from albumy.extensions import db
-from albumy.models import User
+from albumy.models import User, Blob
+from albumy.reaper import guard_files
 from albumy.settings import Operations
+from albumy.storage import storage
 
 
 def generate_token(user, operation, expire_in=None, **kwargs):
@@ -56,26 +70,189 @@ def validate_token(user, token, operation, new_password=None):
     return True
 
 
-def rename_image(old_filename):
-    ext = os.path.splitext(old_filename)[1]
-    new_filename = uuid.uuid4().hex + ext
-    return new_filename
+def store_upload(stream, filename):
+    """把上传的文件按内容寻址保存，返回引用计数已加一的Blob对象。
+    文件边写入临时文件边计算SHA-256，保存为<sha256>.<ext>，已存在相同内容时直接丢弃临时文件"""
+    sha256 = hashlib.sha256()
+    fd, temp_path = tempfile.mkstemp(dir=current_app.config['ALBUMY_UPLOAD_PATH'], suffix='.part')
+    try:
+        with os.fdopen(fd, 'wb') as temp:
+            for chunk in iter(lambda: stream.read(64 * 1024), b''):
+                sha256.update(chunk)
+                temp.write(chunk)
+        return save_blob(temp_path, sha256.hexdigest(), filename)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+def store_file(path, filename):
+    """按内容寻址保存已经完整写入本地磁盘的文件（如分块上传合并后的文件），path会被移动或删除"""
+    sha256 = hashlib.sha256()
+    try:
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(64 * 1024), b''):
+                sha256.update(chunk)
+        return save_blob(path, sha256.hexdigest(), filename)
+    finally:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def save_blob(path, digest, filename):
+    """保存内容摘要为digest的文件，返回引用计数已加一的Blob对象；已存在相同内容时不移动path"""
+    blob = Blob.query.get(digest)
+    if blob is None:
+        name = digest + os.path.splitext(filename)[1].lower()
+        guard_files(db.session, 'photos', [name])  # 上传的事务回滚时删除已保存的文件
+        storage.photos.save_file(name, path)
+        # 相同内容的文件被同时上传时忽略主键冲突，使用先写入的记录。不使用SAVEPOINT：
+        # pysqlite在SAVEPOINT之前不会开始事务，释放SAVEPOINT时会直接提交，事务回滚时无法撤销
+        db.session.execute(insert_ignore(Blob.__table__).values(id=digest, filename=name, refcount=0))
+        blob = Blob.query.get(digest)
+    blob.refcount = Blob.refcount + 1
+    return blob
+
+
+def insert_ignore(table):
+    """忽略主键和唯一约束冲突的INSERT语句"""
+    dialect = db.engine.dialect.name
+    if dialect == 'sqlite':
+        return sqlite_insert(table).on_conflict_do_nothing()
+    if dialect == 'postgresql':
+        return postgresql_insert(table).on_conflict_do_nothing()
+    return table.insert().prefix_with('IGNORE')  # MySQL
+
+
+def resize_images(path, filename, sizes, variants=()):
+    """为用户上传的图片生成多个尺寸的缩略图，sizes为{宽度: 文件名后缀}，返回{宽度: 缩略图文件名}。
+    原图只解码一次：JPEG图片通过draft()在解码时直接按DCT缩放到接近最大缩略图的尺寸，
+    之后从大到小依次生成缩略图，较小的尺寸由上一个尺寸缩放得到。
+    variants为需要额外生成的格式扩展名（如.webp），每个缩略图都会另存一份同名的该格式版本。
+    缩略图保存在原图path所在的目录中；不依赖应用上下文，在后台任务进程中执行"""
+    directory = os.path.dirname(path)
+    name, ext = os.path.splitext(filename)
+    img = Image.open(path)
+    width, height = img.size
+    filenames = {}
+    targets = []
+    for base_width in sorted(sizes, reverse=True):
+        if width <= base_width:
+            filenames[base_width] = filename  # 对于小图，不做处理
+        else:
+            targets.append((base_width, int(height * base_width / width)))  # 对高做同样比例的计算
+    if filenames:  # 原图直接作为缩略图使用时，也需要生成其他格式的版本
+        save_variants(img, os.path.join(directory, os.path.basename(name)), variants)
+    if targets:
+        img.draft(img.mode, targets[0])  # 只对JPEG有效，解码后的尺寸不小于最大的缩略图
+        for size in targets:
+            # 使用抗锯齿缩放，缩小倍数较大时先用reduce()按整数倍快速缩小
+            img = img.resize(size, Image.LANCZOS, reducing_gap=2.0)
+            filenames[size[0]] = name + sizes[size[0]] + ext
+            output = os.path.join(directory, os.path.basename(name + sizes[size[0]]))
+            img.save(output + ext, optimize=True, quality=85)
+            save_variants(img, output, variants)
+    return filenames
+
+
+def save_variants(img, output, variants):
+    """把图片另存为各个格式的版本，output为不含扩展名的路径，Pillow不支持的格式直接跳过"""
+    formats = Image.registered_extensions()
+    for ext in variants:
+        if formats.get(ext) not in Image.SAVE:
+            continue
+        if img.mode not in ('RGB', 'RGBA'):
+            img = img.convert('RGBA' if 'A' in img.mode or 'transparency' in img.info else 'RGB')
+        img.save(output + ext, formats[ext], quality=80)
+
+
+def negotiate_image(backend, filename):
+    """根据请求的Accept首部，在图片和它的各格式版本中选择浏览器支持且体积最小的文件，返回文件名。
+    只考虑Accept中明确列出的类型，*/*和image/*不代表浏览器能解码WebP或AVIF"""
+    accepted = {mimetype for mimetype, quality in request.accept_mimetypes if quality > 0}
+    candidates = [ext for mimetype, ext in current_app.config['ALBUMY_PHOTO_VARIANTS'].items() if mimetype in accepted]
+    if not candidates:
+        return filename
+    sizes = variant_sizes(backend, filename)
+    best, best_size = filename, sizes['']
+    if best_size is None:
+        return filename
+    name = os.path.splitext(filename)[0]
+    for ext in candidates:
+        size = sizes.get(ext)
+        if size is not None and size < best_size:
+            best, best_size = name + ext, size
+    return best
+
+
+def variant_sizes(backend, filename):
+    """返回图片和它的各格式版本的文件大小{扩展名: 大小}，原图的扩展名为''，不存在的版本大小为None。
+    文件内容不会改变，结果缓存ALBUMY_VARIANT_SIZE_TTL秒，使用对象存储时不需要每次请求都查询文件大小"""
+    sizes = cache.get_json('variant-sizes:' + filename)
+    if sizes is None:
+        sizes = store_variant_sizes(backend, filename)
+    return sizes
+
+
+def store_variant_sizes(backend, filename, known=None):
+    """查询并缓存图片和它的各格式版本的文件大小。known为已知的{文件名: 大小}，
+    生成缩略图后直接使用生成的文件大小，不需要再查询存储"""
+    known = known or {}
+    name = os.path.splitext(filename)[0]
+    sizes = {}
+    for ext in ('',) + tuple(current_app.config['ALBUMY_PHOTO_VARIANTS'].values()):
+        target = name + ext if ext else filename
+        if ext and target == filename:
+            continue
+        sizes[ext] = known[target] if target in known else backend.size(target)
+    if sizes[''] is not None:  # 原图不存在时不缓存，避免缓存上传完成前的结果
+        cache.set_json('variant-sizes:' + filename, sizes, current_app.config['ALBUMY_VARIANT_SIZE_TTL'])
+    return sizes
+
+
+def send_upload(backend, filename):
+    """发送上传的图片或头像文件。文件名都是唯一的，内容不会改变，所以允许浏览器长期缓存。
+    对象存储开启预签名时重定向到预签名URL，由对象存储直接发送文件；
+    否则从本地发送，ETag由文件名、大小和修改时间生成，条件请求只需要stat()而不需要打开文件；
+    配置了ALBUMY_ACCEL_REDIRECT_PREFIX时通过X-Accel-Redirect交给Nginx发送文件内容"""
+    max_age = current_app.config['ALBUMY_UPLOAD_MAX_AGE']
+    url = backend.url(filename)
+    if url is not None:
+        response = redirect(url)
+        # 预签名URL会过期，只允许浏览器在有效期内缓存重定向
+        response.cache_control.private = True
+        response.cache_control.max_age = current_app.config['ALBUMY_S3_URL_EXPIRES'] // 2
+        return response
+    try:
+        path = backend.path(filename)
+        st = os.stat(path)
+    except FileNotFoundError:
+        abort(404)
+    etag = hashlib.sha1('{}:{}:{}'.format(filename, st.st_size, st.st_mtime_ns).encode()).hexdigest()
+    last_modified = datetime.fromtimestamp(int(st.st_mtime), timezone.utc)
 
+    prefix = current_app.config['ALBUMY_ACCEL_REDIRECT_PREFIX']
+    relpath = os.path.relpath(path, current_app.config['ALBUMY_UPLOAD_PATH'])
+    if not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+        response = current_app.response_class(status=304)
+        response.headers.remove('Content-Type')
+    elif prefix and not relpath.startswith(os.pardir):
+        response = current_app.response_class(
+            mimetype=mimetypes.guess_type(filename)[0] or 'application/octet-stream')
+        response.headers['X-Accel-Redirect'] = prefix.rstrip('/') + '/' + quote(relpath.replace(os.sep, '/'))
+    else:  # 设置了Flask的USE_X_SENDFILE时，send_file会使用X-Sendfile首部
+        response = send_file(path, etag=etag, last_modified=last_modified, max_age=max_age)
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    response.cache_control.public = True
+    response.cache_control.max_age = max_age
+    response.cache_control.immutable = True
+    return response
 
-def resize_image(image, filename, base_width):
-    """为用户上传的图片生成缩略图， base_width表示缩略图的宽"""
-    filename, ext = os.path.splitext(filename)
-    img = Image.open(image)
-    if img.size[0] <= base_width:
-        return filename + ext  # 对于小图，不做处理
-    w_percent = base_width / float(img.size[0])  # 宽的缩略比
-    h_size = int(float(img.size[1]) * float(w_percent))  # 对高做同样比例的计算
-    img = img.resize((base_width, h_size), Image.ANTIALIAS)  # 使用抗锯齿缩放
 
-    filename += current_app.config['ALBUMY_PHOTO_SUFFIX'][base_width] + ext
-    img.save(os.path.join(current_app.config['ALBUMY_UPLOAD_PATH'], filename),
-             optimize=True, quality=85)
-    return filename
+def count_comment_thread(comment):
+    """统计一条评论及其下所有回复的数量"""
+    return 1 + sum(count_comment_thread(reply) for reply in comment.replies)
 
 
 def is_safe_url(target):
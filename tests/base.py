@@ -0,0 +1,46 @@
+import os
+import shutil
+import unittest
+
+from albumy import create_app
+from albumy.extensions import db
+from albumy.identity import identity_cache
+from albumy.models import Role, User
+
+
+class BaseTestCase(unittest.TestCase):
+    """测试基类：每个测试使用新的应用和临时数据库，创建普通用户normal和另外两个用户"""
+
+    def setUp(self):
+        self.app = create_app('testing')
+        self.context = self.app.test_request_context()
+        self.context.push()
+        self.client = self.app.test_client()
+        self.runner = self.app.test_cli_runner()
+        os.makedirs(self.app.config['AVATARS_SAVE_PATH'], exist_ok=True)  # 同时创建数据库文件所在的目录
+
+        identity_cache.clear()  # 进程内的缓存不随应用重建，数据库重建后用户id会重复
+        db.create_all()
+        Role.init_role()
+        self.normal = self.create_user('normal')
+        self.alice = self.create_user('alice')
+        self.bob = self.create_user('bob')
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.context.pop()
+        shutil.rmtree(os.path.dirname(self.app.config['ALBUMY_UPLOAD_PATH']), ignore_errors=True)
+
+    @staticmethod
+    def create_user(username):
+        user = User(name=username.title(), username=username, email='%s@example.com' % username, confirmed=True)
+        user.set_password('123456')
+        db.session.add(user)
+        db.session.commit()
+        return user
+
+    def login(self, user):
+        with self.client.session_transaction() as session:
+            session['_user_id'] = str(user.id)
+            session['_fresh'] = True
@@ -0,0 +1,71 @@
+from albumy.extensions import db
+from albumy.leaderboard import tag_leaderboard
+from albumy.models import Photo, Tag, Comment, User, rebuild_counters
+from tests.base import BaseTestCase
+
+
+class DeleteUserCountersTestCase(BaseTestCase):
+
+    def add_photo(self, author, tags=()):
+        photo = Photo(filename='photo.jpg', filename_s='photo.jpg', filename_m='photo.jpg', author=author)
+        for name in tags:
+            tag = Tag.query.filter_by(name=name).first() or Tag(name=name)
+            photo.tags.append(tag)
+            tag.photos_count = (tag.photos_count or 0) + 1
+        author.photos_count = User.photos_count + 1
+        db.session.add(photo)
+        db.session.commit()
+        return photo
+
+    def add_comment(self, author, photo, replied=None):
+        db.session.add(Comment(body='comment', author=author, photo=photo, replied=replied))
+        photo.comments_count = Photo.comments_count + 1
+        db.session.commit()
+
+    def counts(self):
+        """返回所有计数器的当前值"""
+        return [tuple(row) for model, columns in [
+            (User, [User.id, User.photos_count, User.collections_count, User.followers_count, User.following_count]),
+            (Photo, [Photo.id, Photo.collectors_count, Photo.comments_count]),
+            (Tag, [Tag.id, Tag.photos_count]),
+        ] for row in db.session.query(*columns).order_by(columns[0])]
+
+    def assert_counts_exact(self):
+        counts = self.counts()
+        rebuild_counters()
+        self.assertEqual(counts, self.counts())
+
+    def test_follow_and_collect_counts(self):
+        photo = self.add_photo(self.normal)
+        self.alice.follow(self.normal)
+        self.normal.follow(self.alice)
+        self.alice.collect(photo)
+        db.session.delete(self.alice)
+        db.session.commit()
+        self.assertEqual((self.normal.followers_count, self.normal.following_count), (0, 0))
+        self.assertEqual(photo.collectors_count, 0)
+        self.assert_counts_exact()
+
+    def test_photo_counts(self):
+        photo = self.add_photo(self.alice, tags=['cat', 'dog'])
+        self.add_photo(self.normal, tags=['dog'])
+        self.normal.collect(photo)
+        db.session.delete(self.alice)
+        db.session.commit()
+        self.assertEqual(self.normal.collections_count, 0)
+        self.assertIsNone(Tag.query.filter_by(name='cat').first())  # 不再被使用的标签被删除
+        self.assertEqual(Tag.query.filter_by(name='dog').one().photos_count, 1)
+        self.assertEqual([tag.name for tag in tag_leaderboard.top()], ['dog'])
+        self.assert_counts_exact()
+
+    def test_comment_thread_counts(self):
+        photo = self.add_photo(self.normal)
+        self.add_comment(self.normal, photo)
+        self.add_comment(self.alice, photo)
+        comment = Comment.query.filter_by(author=self.alice).one()
+        self.add_comment(self.bob, photo, replied=comment)
+        self.add_comment(self.alice, photo, replied=Comment.query.filter_by(author=self.bob).one())
+        db.session.delete(self.alice)
+        db.session.commit()
+        self.assertEqual(photo.comments_count, 1)  # 回复alice评论的评论一同被删除
+        self.assert_counts_exact()
@@ -0,0 +1,61 @@
+from unittest import mock
+
+from albumy.cache import cache
+from albumy.extensions import db
+from albumy.identity import identity_cache, UserSnapshot
+from albumy.models import User
+from tests.base import BaseTestCase
+
+
+class IdentityCacheTestCase(BaseTestCase):
+
+    def delete_elsewhere(self, user):
+        """模拟其他进程删除用户：直接执行SQL，不触发本进程的失效事件"""
+        db.session.execute(User.__table__.delete().where(User.id == user.id))
+        db.session.commit()
+
+    def test_update_invalidates_snapshot(self):
+        self.assertEqual(identity_cache.get(self.alice.id).name, 'Alice')
+        self.alice.name = 'Alice Liddell'
+        db.session.commit()
+        self.assertEqual(identity_cache.get(self.alice.id).name, 'Alice Liddell')
+
+    def test_deleted_user_is_logged_out(self):
+        user_id = self.alice.id
+        self.login(self.alice)
+        self.assertEqual(self.client.get('/user/settings/profile').status_code, 200)
+
+        self.delete_elsewhere(self.alice)  # 进程内缓存的快照还没有过期
+        response = self.client.get('/user/settings/profile')
+        self.assertEqual(response.status_code, 302)
+        self.assertIn('/auth/login', response.location)
+        self.assertIsNone(identity_cache.get(user_id))
+
+
+class SharedIdentityCacheTestCase(BaseTestCase):
+    """共享快照的测试，使用进程内缓存后端代替Redis"""
+
+    def setUp(self):
+        super(SharedIdentityCacheTestCase, self).setUp()
+        self.app.config['ALBUMY_CACHE_TYPE'] = 'redis'
+
+    def test_invalidation_during_load_is_not_written_back(self):
+        load = UserSnapshot.load
+
+        def load_then_update(user_id):
+            snapshot = load(user_id)  # 读取到旧数据后，其他进程提交了修改
+            self.alice.name = 'Alice Liddell'
+            db.session.commit()
+            return snapshot
+
+        with mock.patch.object(UserSnapshot, 'load', side_effect=load_then_update):
+            self.assertEqual(identity_cache.get(self.alice.id).name, 'Alice')
+        self.assertIsNone(cache.get_json('identity:%d' % self.alice.id))
+        self.assertEqual(identity_cache.get(self.alice.id).name, 'Alice Liddell')
+
+    def test_deleted_user_is_seen_by_next_request(self):
+        user_id = self.alice.id
+        self.assertIsNotNone(identity_cache.get(user_id))
+        db.session.delete(self.alice)
+        db.session.commit()
+        self.assertIsNone(identity_cache.get(user_id))
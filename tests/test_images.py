@@ -0,0 +1,55 @@
+from unittest import mock
+
+from albumy.extensions import db
+from albumy.models import Photo
+from albumy.storage import storage
+from albumy.thumbnails import thumbnails_ready
+from albumy.utils import negotiate_image
+from tests.base import BaseTestCase
+
+
+class NegotiateImageTestCase(BaseTestCase):
+
+    def save(self, name, size):
+        path = storage.photos.staging_path(name)
+        with open(path, 'wb') as f:
+            f.write(b'x' * size)
+        return path
+
+    def negotiate(self, filename, accept='image/avif,image/webp,*/*'):
+        with self.app.test_request_context(headers={'Accept': accept}):
+            return negotiate_image(storage.photos, filename)
+
+    def test_smallest_accepted_variant(self):
+        storage.photos.save_file('photo.jpg', self.save('photo.jpg', 100))
+        storage.photos.save_file('photo.webp', self.save('photo.webp', 60))
+        self.assertEqual(self.negotiate('photo.jpg'), 'photo.webp')
+        self.assertEqual(self.negotiate('photo.jpg', accept='image/*'), 'photo.jpg')
+
+    def test_sizes_are_cached(self):
+        storage.photos.save_file('photo.jpg', self.save('photo.jpg', 100))
+        storage.photos.save_file('photo.webp', self.save('photo.webp', 60))
+        self.negotiate('photo.jpg')
+        with mock.patch.object(storage.photos, 'size') as size:
+            self.assertEqual(self.negotiate('photo.jpg'), 'photo.webp')
+            size.assert_not_called()
+
+    def test_sizes_written_with_renditions(self):
+        storage.photos.save_file('photo.jpg', self.save('photo.jpg', 500))
+        photo = Photo(filename='photo.jpg', filename_s='photo.jpg', filename_m='photo.jpg',
+                      rendition_status='pending', author=self.normal)
+        db.session.add(photo)
+        db.session.commit()
+        self.assertEqual(self.negotiate('photo_s.jpg'), 'photo_s.jpg')  # 缩略图生成前的请求
+
+        self.save('photo_s.jpg', 100)
+        self.save('photo_s.webp', 40)
+        self.save('photo_m.jpg', 300)
+        self.save('photo_m.webp', 400)
+        sizes = self.app.config['ALBUMY_PHOTO_SIZE']
+        with mock.patch.object(storage.photos, 'size') as size:
+            thumbnails_ready(photo.id, None, 'photo.jpg',
+                             {sizes['small']: 'photo_s.jpg', sizes['medium']: 'photo_m.jpg'})
+            self.assertEqual(self.negotiate('photo_s.jpg'), 'photo_s.webp')
+            self.assertEqual(self.negotiate('photo_m.jpg'), 'photo_m.jpg')
+            size.assert_not_called()
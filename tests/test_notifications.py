@@ -0,0 +1,135 @@
+from datetime import datetime, timedelta
+
+from albumy.extensions import db
+from albumy.models import Notification, NotificationActor, NotificationEvent
+from albumy.notifications import write_notifications, unread_count, push_collect_notification, prune_notifications
+from tests.base import BaseTestCase
+
+
+class NotificationWriterTestCase(BaseTestCase):
+
+    def add_event(self, actor, kind='collect', target_id=1, receiver=None):
+        db.session.add(NotificationEvent(kind=kind, actor_id=actor.id, receiver_id=(receiver or self.normal).id,
+                                         target_id=target_id))
+        db.session.commit()
+
+    def notifications(self):
+        return Notification.query.filter_by(receiver_id=self.normal.id).order_by(Notification.id).all()
+
+    def test_coalesce_distinct_actors(self):
+        self.add_event(self.alice)
+        self.add_event(self.bob)
+        self.add_event(self.alice)
+        write_notifications()
+        notifications = self.notifications()
+        self.assertEqual(len(notifications), 1)
+        self.assertEqual(notifications[0].actors_count, 2)
+        self.assertEqual(notifications[0].actor_id, self.alice.id)
+        self.assertEqual(NotificationEvent.query.count(), 0)
+
+    def test_coalesce_into_unread_notification(self):
+        self.add_event(self.alice)
+        write_notifications()
+        self.add_event(self.bob)
+        self.add_event(self.alice)
+        write_notifications()
+        notifications = self.notifications()
+        self.assertEqual(len(notifications), 1)
+        self.assertEqual(notifications[0].actors_count, 2)
+        self.assertEqual(notifications[0].actor_id, self.alice.id)
+
+    def test_actor_counted_once_across_batches(self):
+        for actor in self.alice, self.bob, self.alice:  # 收藏、取消收藏后再次收藏
+            self.add_event(actor)
+            write_notifications()
+        self.assertEqual(self.notifications()[0].actors_count, 2)
+
+    def test_repeated_actor_is_not_counted_again(self):
+        self.add_event(self.alice)
+        write_notifications()
+        self.add_event(self.alice)
+        write_notifications()
+        self.assertEqual(self.notifications()[0].actors_count, 1)
+
+    def test_different_kind_or_target_is_not_coalesced(self):
+        self.add_event(self.alice, target_id=1)
+        self.add_event(self.alice, target_id=2)
+        self.add_event(self.alice, kind='comment', target_id=1)
+        write_notifications()
+        self.assertEqual(len(self.notifications()), 3)
+
+    def test_coalesce_window(self):
+        self.add_event(self.alice)
+        write_notifications()
+        notification = self.notifications()[0]
+        notification.timestamp = datetime.utcnow() - timedelta(
+            seconds=self.app.config['ALBUMY_NOTIFICATION_COALESCE_WINDOW'] + 60)
+        db.session.commit()
+        self.add_event(self.bob)
+        write_notifications()
+        self.assertEqual(len(self.notifications()), 2)
+
+    def test_read_notification_is_not_coalesced(self):
+        self.add_event(self.alice)
+        write_notifications()
+        self.notifications()[0].is_read = True
+        db.session.commit()
+        self.add_event(self.bob)
+        write_notifications()
+        self.assertEqual([n.actors_count for n in self.notifications()], [1, 1])
+
+    def test_unread_count_only_bumped_by_new_notification(self):
+        self.assertEqual(unread_count(self.normal.id), 0)
+        self.add_event(self.alice)
+        write_notifications()
+        self.assertEqual(unread_count(self.normal.id), 1)
+        self.add_event(self.bob)
+        write_notifications()
+        self.assertEqual(unread_count(self.normal.id), 1)
+        self.add_event(self.alice, target_id=2)
+        write_notifications()
+        self.assertEqual(unread_count(self.normal.id), 2)
+
+    def test_claimed_receiver_is_skipped(self):
+        self.add_event(self.alice)
+        self.add_event(self.bob, receiver=self.alice)
+        head = NotificationEvent.query.filter_by(receiver_id=self.normal.id).first()
+        head.claimed_until = datetime.utcnow() + timedelta(seconds=60)  # 其他线程正在处理
+        db.session.commit()
+        write_notifications()
+        self.assertEqual(self.notifications(), [])
+        self.assertEqual(Notification.query.filter_by(receiver_id=self.alice.id).count(), 1)
+        self.assertEqual(NotificationEvent.query.count(), 1)
+
+        head.claimed_until = datetime.utcnow() - timedelta(seconds=1)  # 租约到期
+        db.session.commit()
+        write_notifications()
+        self.assertEqual(len(self.notifications()), 1)
+        self.assertEqual(NotificationEvent.query.count(), 0)
+
+    def test_unprocessed_receivers_are_released(self):
+        self.app.config['ALBUMY_NOTIFICATION_BATCH'] = 2
+        self.add_event(self.alice)
+        self.add_event(self.alice, target_id=2)
+        self.add_event(self.alice, receiver=self.bob)
+        self.assertTrue(write_notifications())
+        self.assertEqual(NotificationEvent.query.filter(NotificationEvent.claimed_until.isnot(None)).count(), 0)
+        self.assertFalse(write_notifications())
+        self.assertEqual(NotificationEvent.query.count(), 0)
+
+    def test_push_writes_after_commit(self):
+        push_collect_notification(collector=self.alice, photo_id=1, receiver=self.normal)
+        self.assertEqual(len(self.notifications()), 1)
+
+    def test_leftover_events_written_on_first_request(self):
+        self.add_event(self.alice)
+        self.client.get('/explore')
+        self.assertEqual(len(self.notifications()), 1)
+
+    def test_prune_deletes_actors(self):
+        self.add_event(self.alice)
+        write_notifications()
+        self.notifications()[0].is_read = True
+        db.session.commit()
+        self.assertEqual(prune_notifications(datetime.utcnow() + timedelta(seconds=1)), 1)
+        self.assertEqual(NotificationActor.query.count(), 0)
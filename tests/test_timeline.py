@@ -0,0 +1,53 @@
+from albumy.extensions import db
+from albumy.models import Photo, Timeline
+from albumy.timeline import fan_out_photo, read_timeline, rebuild_timeline
+from tests.base import BaseTestCase
+
+
+class TimelineTestCase(BaseTestCase):
+
+    def setUp(self):
+        super(TimelineTestCase, self).setUp()
+        self.app.config['ALBUMY_TIMELINE_FANOUT_LIMIT'] = 1
+
+    def upload(self, author):
+        """按上传视图的方式写入图片"""
+        photo = Photo(filename='photo.jpg', filename_s='photo.jpg', filename_m='photo.jpg', author=author)
+        db.session.add(photo)
+        db.session.flush()
+        fan_out_photo(photo)
+        db.session.commit()
+        return photo.id
+
+    def timeline(self, user):
+        return [photo.id for photo in read_timeline(user).items]
+
+    def test_unfanned_photos_kept_after_author_drops_below_limit(self):
+        self.normal.follow(self.alice)
+        self.bob.follow(self.alice)  # alice的关注者超过阈值
+        first = self.upload(self.alice)
+        self.assertEqual(Timeline.query.count(), 0)
+
+        self.bob.unfollow(self.alice)  # 关注者回到阈值以下
+        second = self.upload(self.alice)
+        self.assertEqual(self.timeline(self.normal), [second, first])
+
+    def test_fanned_photos_kept_after_author_rises_above_limit(self):
+        self.normal.follow(self.alice)
+        first = self.upload(self.alice)
+
+        self.bob.follow(self.alice)  # alice的关注者超过阈值，回填已写扩散的图片
+        second = self.upload(self.alice)
+        self.assertEqual(self.timeline(self.normal), [second, first])
+        self.assertEqual(self.timeline(self.bob), [second, first])
+
+    def test_rebuild_uses_current_followers(self):
+        self.normal.follow(self.alice)
+        self.bob.follow(self.alice)
+        photo_id = self.upload(self.alice)
+        self.bob.unfollow(self.alice)
+
+        rebuild_timeline()
+        self.assertTrue(Photo.query.get(photo_id).fanned_out)
+        self.assertEqual(Timeline.query.filter_by(user_id=self.normal.id).count(), 1)
+        self.assertEqual(self.timeline(self.normal), [photo_id])
@@ -0,0 +1,58 @@
+import io
+from datetime import datetime
+
+from albumy.extensions import db
+from albumy.models import Blob, Tombstone
+from albumy.reaper import reap_files
+from albumy.storage import storage
+from albumy.utils import store_upload
+from tests.base import BaseTestCase
+
+
+class StoreUploadTestCase(BaseTestCase):
+
+    def store(self, data=b'photo data'):
+        return store_upload(io.BytesIO(data), 'photo.JPG')
+
+    def test_committed_upload_cancels_guard(self):
+        blob = self.store()
+        db.session.commit()
+        self.assertIsNotNone(storage.photos.size(blob.filename))
+        self.assertEqual(Tombstone.query.count(), 0)
+
+    def test_rolled_back_upload_is_reaped(self):
+        filename = self.store().filename
+        db.session.rollback()
+        self.assertIsNone(Blob.query.get(filename.split('.')[0]))
+        tombstone = Tombstone.query.filter_by(storage='photos', filename=filename).one()
+        self.assertGreater(tombstone.next_attempt, datetime.utcnow())  # 上传的请求可能还没有结束，不能立即删除
+
+        tombstone.next_attempt = datetime.utcnow()
+        db.session.commit()
+        reap_files()
+        self.assertIsNone(storage.photos.size(filename))
+        self.assertEqual(Tombstone.query.count(), 0)
+
+    def test_existing_blob_is_not_guarded(self):
+        self.store()
+        db.session.commit()
+        blob = self.store()
+        db.session.commit()
+        self.assertEqual(blob.refcount, 2)
+        self.assertEqual(Tombstone.query.count(), 0)
+
+
+class ChunkedUploadTestCase(BaseTestCase):
+
+    def send_chunk(self, index, data=b'0123456789', count=2):
+        return self.client.post('/upload', data={
+            'file': (io.BytesIO(data[index * 5:index * 5 + 5]), 'photo.jpg'),
+            'dzuuid': 'upload-1', 'dzchunkindex': index, 'dztotalchunkcount': count,
+            'dztotalfilesize': len(data), 'dzchunkbyteoffset': index * 5})
+
+    def test_status_lists_received_chunks(self):
+        self.login(self.normal)
+        self.assertEqual(self.client.get('/upload/status/upload-1').json['chunks'], [])
+        self.assertEqual(self.send_chunk(1).status_code, 204)
+        self.assertEqual(self.client.get('/upload/status/upload-1').json, {'chunks': [1], 'size': 10})
+